@@ -4,10 +4,21 @@ __version__ = "2.0.0"
 __author__ = "OpenChemIE Team"
 __email__ = "contact@openchemie.org"
 
-from app.core.extractor import OpenChemIEExtractor
-from app.core.interface import ChemicalExtractionInterface
-
 __all__ = [
     "OpenChemIEExtractor", 
     "ChemicalExtractionInterface"
-]
\ No newline at end of file
+]
+
+# Exports are imported on first access (PEP 562) so that importing the package
+# or a light submodule does not pull in torch and the model libraries.
+_LAZY_EXPORTS = {
+    "OpenChemIEExtractor": "app.core.extractor",
+    "ChemicalExtractionInterface": "app.core.interface",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_EXPORTS:
+        import importlib
+        return getattr(importlib.import_module(_LAZY_EXPORTS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
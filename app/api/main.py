@@ -1,6 +1,14 @@
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 
-app = FastAPI(title="OpenChemIE API")
+# orjson 为可选依赖，安装后接口响应改用 orjson 序列化
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except ImportError:
+    DefaultResponse = JSONResponse
+
+app = FastAPI(title="OpenChemIE API", default_response_class=DefaultResponse)
 
 @app.get("/")
 def read_root():
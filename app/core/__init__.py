@@ -1 +1,6 @@
-from .interface import OpenChemIE
+def __getattr__(name):
+    # import the model stack only when OpenChemIE is actually requested
+    if name == "OpenChemIE":
+        from .interface import OpenChemIE
+        return OpenChemIE
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,11 +1,17 @@
-from PyPDF2 import PdfReader, PdfWriter
 import pdfminer.high_level
 import pdfminer.layout
 from operator import itemgetter
 import os
-import pdftotext
+import fitz
+from .pdfrender import FITZ_LOCK
 from chemrxnextractor import RxnExtractor
 
+def get_pdf_text(pdf):
+    # one string per page, text blocks separated by blank lines as get_paragraphs_from_pdf expects
+    with FITZ_LOCK, fitz.open(pdf) as doc:
+        return ["\n\n".join(block[4].strip() for block in page.get_text("blocks") if block[6] == 0)
+                for page in doc]
+
 class ChemRxnExtractor(object):
     def __init__(self, pdf, pn, model_dir, device):
         self.pdf_file = pdf
@@ -16,13 +22,11 @@ class ChemRxnExtractor(object):
         self.text_file = "info.txt"
         self.pdf_text = ""
         if len(self.pdf_file) > 0:
-            with open(self.pdf_file, "rb") as f:
-                self.pdf_text = pdftotext.PDF(f)
+            self.pdf_text = get_pdf_text(self.pdf_file)
         
     def set_pdf_file(self, pdf):
         self.pdf_file = pdf
-        with open(self.pdf_file, "rb") as f:
-            self.pdf_text = pdftotext.PDF(f)
+        self.pdf_text = get_pdf_text(self.pdf_file)
     
     def set_pages(self, pn):
         self.pages = pn
@@ -5,20 +5,71 @@ OpenChemIE 化学信息提取工具 v2.0
 采用优化的JSON输出结构，更清晰、更有条理
 """
 
-import torch
-from openchemie import OpenChemIE
+import numpy as np
 import os
+import io
+import base64
 import json
-import argparse
-import cv2
-import glob
 import time
-import psutil
+import gc
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-import sys
-from rdkit import Chem
-from rdkit.Chem import Descriptors, Crippen
+import re
+
+# orjson 为可选依赖，未安装时回退到标准库 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 表格单元格解析用的正则，模块加载时编译一次
+# 匹配整数、小数、科学计数法，允许结尾有单位
+_NUMERIC_CELL_PATTERN = re.compile(r"^[-\u2212\s]*(\d{1,3}(,\d{3})*|\d+)(\.\d*)?([eE][+-]?\d+)?.*")
+# 范围，如 "10-20"，用 search 匹配，避免前后 .* 的回溯
+_RANGE_CELL_PATTERN = re.compile(r"\d+\s*-\s*\d+")
+# 单元格中的第一个数值
+_NUMBER_PATTERN = re.compile(r"[-−\s]*\d+(\.\d*)?")
+
+# 表格列标签到数据类型和语义角色的映射
+_NUMERIC_TAGS = frozenset(["measurement", "temperature", "time", "result", "ratio"])
+_CATEGORICAL_TAGS = frozenset(["substance", "alkyl group", "solvent", "catalyst"])
+_SEMANTIC_ROLES = {
+    "substance": "Reactant/Product",
+    "reactant": "Reactant",
+    "product": "Product",
+    "catalyst": "Catalyst",
+    "solvent": "Solvent",
+    "temperature": "Condition-Temperature",
+    "time": "Condition-Time",
+    "yield": "Result-Yield",
+    "ee": "Result-EnantiomericExcess",
+    "ratio": "Stoichiometry"
+}
+
+
+def _encode_png_base64(image):
+    """将图像编码为base64 PNG字符串；使用最低压缩级别，编码速度优先于文件大小"""
+    if image is None or isinstance(image, str):
+        return image
+    if isinstance(image, np.ndarray):
+        from PIL import Image
+        image = Image.fromarray(image)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def _dumps(obj, indent=False):
+    """序列化为UTF-8编码的JSON字节串，优先使用orjson；indent=True 时缩进2个空格"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
 
 
 class OpenChemIEExtractorV2:
@@ -31,21 +82,70 @@ class OpenChemIEExtractorV2:
             verbose: 是否显示详细信息
         """
         self.verbose = verbose
+        # torch 导入耗时数秒，推迟到创建提取器时，--help 等命令行操作无需加载；其余方法都在此之后调用
+        global torch
+        import torch
+        from app.core.pdfrender import get_render_pool
+        
+        # 限制显存块拆分，缓解多阶段推理后的显存碎片（需在CUDA初始化前设置）
+        # torch 2.1 起支持可扩展段，尺寸多变的页面/图片反复分配时不再产生无法复用的碎片
+        alloc_conf = "max_split_size_mb:128"
+        if tuple(int(v) for v in re.findall(r"\d+", torch.__version__)[:2]) >= (2, 1):
+            alloc_conf = "expandable_segments:True,garbage_collection_threshold:0.8," + alloc_conf
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", alloc_conf)
         self.schema_version = "2.0.0"
         self.extractor_version = "2.0.0"
+        # 每次渲染并处理的页数，可通过环境变量 OCIE_PAGE_CHUNK 调整，限制页面图像占用的内存
+        self.page_chunk_size = int(os.environ.get("OCIE_PAGE_CHUNK", 10))
+        # 单页渲染的最大像素数，超大页面降低分辨率渲染，避免送入模型的图像过大导致显存溢出
+        self.max_pixels = int(os.environ.get("OCIE_MAX_PIXELS", 2048 * 2048))
+        # 模型推理批大小，可通过环境变量 OCIE_BATCH 调整，显存不足时自动减半
+        self.batch_size = int(os.environ.get("OCIE_BATCH", 16))
+        # 并行运行提取步骤的线程数，可通过环境变量 OCIE_STAGE_WORKERS 调整，设为1即串行执行
+        self.stage_workers = int(os.environ.get("OCIE_STAGE_WORKERS", 3))
+        # 最多每隔多少个分块强制释放一次显存缓存，可通过环境变量 OCIE_FLUSH_INTERVAL 调整
+        self.flush_interval = int(os.environ.get("OCIE_FLUSH_INTERVAL", 10))
+        self._chunks_since_flush = 0
+        # 渲染页面的进程数，可通过环境变量 OCIE_RENDER_WORKERS 调整，设为1即在当前进程内渲染
+        self.render_workers = int(os.environ.get("OCIE_RENDER_WORKERS", min(os.cpu_count() or 1, self.page_chunk_size)))
+        # 渲染进程池在启动任何工作线程之前创建一次，所有PDF复用；使用spawn而非fork，避免多线程进程fork死锁
+        self._render_pool = get_render_pool(self.render_workers) if self.render_workers > 1 else None
         
         # 设置设备
         if device is None:
             self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         else:
             self.device = torch.device(device)
+        # 多GPU时先切换当前设备，empty_cache 等调用以及模型库内部用 'cuda' 创建的张量才会落在指定的GPU上
+        if self.device.type == 'cuda' and self.device.index is not None:
+            torch.cuda.set_device(self.device)
+        
+        # 推理精度：CUDA 上默认 bfloat16 混合精度（GPU不支持时为 float16），可用 OCIE_DTYPE=bf16/fp16/fp32 覆盖
+        self.dtype = self._resolve_dtype(os.environ.get("OCIE_DTYPE"))
+        if self.device.type == 'cpu':
+            # CPU推理时各阶段线程同时运行，每个算子默认占满所有核心会造成超额订阅；
+            # 按物理核心数在阶段线程间平分，可用 OCIE_NUM_THREADS 指定
+            import psutil
+            physical_cores = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+            num_threads = int(os.environ.get("OCIE_NUM_THREADS", max(1, physical_cores // max(1, self.stage_workers))))
+            torch.set_num_threads(num_threads)
+        if self.device.type == 'cuda':
+            # 页面按固定dpi渲染、各模型输入尺寸基本固定，让cuDNN为这些尺寸选择最快的卷积实现
+            torch.backends.cudnn.benchmark = True
+            # 允许float32矩阵乘法和卷积使用TF32 Tensor Core（Ampere及以上），autocast之外的运算也能受益
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            if hasattr(torch, "set_float32_matmul_precision"):
+                torch.set_float32_matmul_precision("high")
         
         if self.verbose:
             print(f"🚀 OpenChemIE提取器 v{self.extractor_version} 初始化")
             print(f"📱 使用设备: {self.device}")
+            print(f"🔢 推理精度: {self.dtype}")
         
-        # 初始化模型
+        # 初始化模型；openchemie 会连带导入各识别模型库，延迟到这里导入以加快 --help 等命令
         try:
+            from openchemie import OpenChemIE
             self.model = OpenChemIE(device=self.device)
             if self.verbose:
                 print("✅ 模型加载成功")
@@ -53,6 +153,13 @@ class OpenChemIEExtractorV2:
             print(f"❌ 模型加载失败: {e}")
             raise
 
+        # 启动时并发加载各阶段要用的模型，避免并行阶段重复懒加载同一个模型
+        self._preload_models()
+
+        # 设置 OCIE_COMPILE=1 时用 torch.compile 编译各识别模型，首次调用编译较慢，适合批量处理
+        if os.environ.get("OCIE_COMPILE", "0") == "1":
+            self._compile_models()
+
     def extract_from_pdf(self, pdf_path, output_images=False, output_bbox=True, extract_corefs=True):
         """
         从PDF文件中提取化学信息 - 新版本结构
@@ -67,6 +174,10 @@ class OpenChemIEExtractorV2:
             dict: 优化结构的提取结果
         """
         start_time = time.time()
+        # 以本次提取开始为CPU占用的采样起点：统计时非阻塞的 cpu_percent() 返回的即为提取期间的平均占用，
+        # 否则首次调用只会返回无意义的 0.0
+        import psutil
+        psutil.cpu_percent(interval=None)
         
         if self.verbose:
             print(f"\n🔍 开始处理PDF: {pdf_path}")
@@ -87,41 +198,80 @@ class OpenChemIEExtractorV2:
         })
         
         try:
-            # 提取分子
-            if self.verbose:
-                print("🧪 提取分子...")
-            molecules_data = self._extract_molecules_from_pdf(pdf_path, output_bbox, output_images)
-            
-            # 提取反应
-            if self.verbose:
-                print("⚗️ 提取反应...")
-            reactions_data = self._extract_reactions_from_pdf(pdf_path, output_bbox)
-            
-            # 提取图片
-            if self.verbose:
-                print("🖼️ 提取图片...")
-            figures_data = self._extract_figures_from_pdf(pdf_path, output_bbox, output_images)
+            molecules_data = {"from_figures": [], "from_text": []}
+            reactions_data, figures_data, tables_data = [], [], []
+            corefs_data = []
+            total_pages = 0
             
-            # 提取表格
-            if self.verbose:
-                print("📊 提取表格...")
-            tables_data = self._extract_tables_from_pdf(pdf_path, output_bbox)
+            # 分块渲染页面，每块的页面图像由各提取步骤共用，处理完即释放
+            # 除了图片模型依赖图片检测结果外，各提取步骤之间没有数据依赖，在线程池中并行运行，
+            # 让pdfminer的表格/标题解析等CPU工作与GPU推理重叠
+            with ThreadPoolExecutor(max_workers=self.stage_workers) as executor:
+                # 从文本中提取分子（只读文本层，整本处理一次）
+                text_future = executor.submit(self._run_stage, self._extract_molecules_from_text, pdf_path)
+                
+                for first_page, pages in self._iter_page_chunks(pdf_path):
+                    total_pages += len(pages)
+                    if self.verbose:
+                        print(f"📄 处理第 {first_page + 1}-{first_page + len(pages)} 页...")
+                        print("🧪 提取分子 | ⚗️ 提取反应 | 🖼️ 提取图片 | 📊 提取表格" + (" | 🔗 提取分子共指关系" if extract_corefs else ""))
+                    
+                    # 表格与图片检测互不依赖，并行运行
+                    tables_future = executor.submit(
+                        self._run_stage, self._extract_tables_from_pdf,
+                        pdf_path, pages, first_page, output_bbox
+                    )
+                    # 图片只检测、裁剪一次，分子、反应和共指关系模型共用同一批图片
+                    figures = executor.submit(
+                        self._run_stage, self._extract_figures_from_pdf,
+                        pdf_path, pages, first_page, output_bbox
+                    ).result()
+                    molecules_future = executor.submit(self._run_stage, self._extract_molecules_from_figures, figures)
+                    reactions_future = executor.submit(self._run_stage, self._extract_reactions_from_figures, figures)
+                    corefs_future = None
+                    if extract_corefs:
+                        corefs_future = executor.submit(self._run_stage, self._extract_coreferences_from_figures, figures)
+                    
+                    # 按固定顺序收集结果，保证输出与串行执行一致
+                    molecules = molecules_future.result()
+                    molecules_data["from_figures"].extend(molecules if output_images else self._strip_molecule_images(molecules))
+                    reactions_data.extend(reactions_future.result())
+                    figures_data.extend(figures if output_images else self._strip_figure_images(figures))
+                    tables_data.extend(tables_future.result())
+                    if corefs_future is not None:
+                        corefs_data.extend(corefs_future.result())
+                    
+                    # 释放当前分块的页面图像，引用计数归零即回收，无需每个分块都 gc.collect() 遍历整个堆
+                    del pages, figures, molecules
+                    self._gpu_flush()
+                
+                molecules_data["from_text"] = text_future.result()
             
-            # 提取共指关系
-            corefs_data = {}
-            if extract_corefs:
-                if self.verbose:
-                    print("🔗 提取分子共指关系...")
-                corefs_data = self._extract_coreferences_from_pdf(pdf_path)
+            results["metadata"]["document_info"]["total_pages"] = total_pages
             
             # 组装化学实体数据
-            results["chemical_entities"] = self._build_chemical_entities(molecules_data, reactions_data)
+            chemical_entities = self._build_chemical_entities(molecules_data, reactions_data)
+            results["chemical_entities"] = chemical_entities
             
             # 组装文档内容数据
-            results["document_content"] = self._build_document_content(figures_data, tables_data)
+            document_content = self._build_document_content(figures_data, tables_data)
+            results["document_content"] = document_content
+            results["document_structure"]["total_figures"] = len(document_content["figures"])
+            results["document_structure"]["total_tables"] = len(document_content["tables"])
             
             # 组装关系数据
-            results["relationships"] = self._build_relationships(corefs_data, molecules_data)
+            relationships = self._build_relationships(corefs_data, molecules_data)
+            results["relationships"] = relationships
+            
+            # 各部分的计数在组装时即已得到，直接传给统计，不再回头遍历结果树
+            counts = {
+                "total_pages": total_pages,
+                "total_figures": len(document_content["figures"]),
+                "total_tables": len(document_content["tables"]),
+                "total_unique_molecules": chemical_entities["molecules"]["total_unique_molecules"],
+                "total_reactions": chemical_entities["reactions"]["total_reactions"],
+                "total_coref_clusters": relationships["coreferences"]["total_clusters"]
+            }
             
             # 计算质量指标
             results["quality_metrics"] = self._calculate_quality_metrics(molecules_data, reactions_data, tables_data, corefs_data)
@@ -132,7 +282,7 @@ class OpenChemIEExtractorV2:
             
             # 更新处理信息
             results["metadata"]["extraction_info"]["processing_time_seconds"] = round(processing_time, 2)
-            results["statistics"] = self._calculate_statistics(results, processing_time)
+            results["statistics"] = self._calculate_statistics(counts, processing_time)
             
             if self.verbose:
                 print(f"✅ 处理完成！耗时: {processing_time:.2f}秒")
@@ -143,6 +293,8 @@ class OpenChemIEExtractorV2:
         except Exception as e:
             if self.verbose:
                 print(f"❌ 处理过程中出错: {e}")
+            # 出错时中断的分块可能留下大量缓存显存，强制释放
+            self._gpu_flush(force=True)
             raise
 
     def _get_file_info(self, file_path):
@@ -169,7 +321,7 @@ class OpenChemIEExtractorV2:
                     "file_name": os.path.basename(file_path),
                     "file_type": "pdf",
                     "file_size_mb": file_info["size_mb"],
-                    "total_pages": 0,  # 将在处理过程中更新
+                    "total_pages": 0,  # 渲染完所有页面后更新
                     "language": "auto_detected"
                 },
                 "extraction_config": config
@@ -187,54 +339,189 @@ class OpenChemIEExtractorV2:
             "statistics": {}
         }
 
-    def _extract_molecules_from_pdf(self, pdf_path, output_bbox, output_images):
-        """提取分子信息"""
+    def _preload_models(self):
+        """并发加载 extract_from_pdf 用到的全部模型，读取权重的IO相互重叠"""
+        names = ("pdfparser", "moldet", "molscribe", "rxnscribe", "coref", "chemner")
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            # 每个属性只由一个线程访问，不存在重复初始化
+            list(executor.map(lambda name: getattr(self.model, name), names))
+        if self.verbose:
+            print(f"📦 模型权重加载完成，用时 {time.time() - start_time:.1f}s")
+
+    def _compile_models(self):
+        """用 torch.compile 编译 MolScribe / RxnScribe / MolDetect 的网络模块"""
+        if not hasattr(torch, "compile"):
+            if self.verbose:
+                print("⚠️ 当前torch版本不支持torch.compile，跳过模型编译")
+            return
+        # 图像尺寸固定但生成序列长度可变，使用动态形状避免每个长度重新编译
+        for name in ("molscribe", "rxnscribe", "coref"):
+            predictor = getattr(self.model, name)
+            for attr in ("encoder", "decoder", "model"):
+                module = getattr(predictor, attr, None)
+                if isinstance(module, torch.nn.Module):
+                    setattr(predictor, attr, torch.compile(module, dynamic=True))
+        if self.verbose:
+            print("⚙️ 已启用torch.compile模型编译")
+
+    def _resolve_dtype(self, name):
+        """解析 OCIE_DTYPE 环境变量对应的推理精度"""
+        dtypes = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+        if name:
+            if name.lower() not in dtypes:
+                raise ValueError(f"不支持的 OCIE_DTYPE: {name}，可选 {', '.join(dtypes)}")
+            dtype = dtypes[name.lower()]
+        else:
+            dtype = torch.float32
+            if self.device.type == 'cuda':
+                # bfloat16 与 float32 指数范围相同，解码时不会像 float16 那样溢出
+                bf16_supported = hasattr(torch.cuda, "is_bf16_supported") and torch.cuda.is_bf16_supported()
+                dtype = torch.bfloat16 if bf16_supported else torch.float16
+        # CPU 上的 autocast 只支持 bfloat16
+        if self.device.type != 'cuda' and dtype == torch.float16:
+            dtype = torch.float32
+        return dtype
+
+    def _inference_mode(self):
+        """推理上下文：关闭自动求导，旧版 torch 退回 no_grad"""
+        if hasattr(torch, "inference_mode"):
+            return torch.inference_mode()
+        return torch.no_grad()
+
+    def _autocast(self):
+        """模型调用的混合精度上下文，fp32 或旧版 torch 下不做任何处理"""
+        if self.dtype == torch.float32 or not hasattr(torch, "autocast"):
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+    def _iter_page_chunks(self, pdf_path):
+        """按 self.page_chunk_size 分块，用常驻渲染进程池渲染页面，逐块产出 (起始页索引, 页面图像列表)"""
+        # 渲染只依赖 fitz，用到时再导入
+        from app.core.pdfrender import get_pages_from_pdf
+        
+        first_page = 0
+        while True:
+            pages = get_pages_from_pdf(
+                pdf_path, num_pages=first_page + self.page_chunk_size,
+                first_page=first_page, num_workers=self.render_workers,
+                max_pixels=self.max_pixels, executor=self._render_pool
+            )
+            if not pages:
+                return
+            count = len(pages)
+            yield first_page, pages
+            # 渲染下一块之前先释放对上一块的引用
+            del pages
+            first_page += count
+
+    def _stage_stream(self):
+        """CUDA上为每个提取步骤分配独立的流，使不同步骤的GPU计算可以重叠"""
+        if self.device.type != 'cuda':
+            return contextlib.nullcontext()
+        return torch.cuda.stream(torch.cuda.Stream(device=self.device))
+
+    def _run_stage(self, extract_fn, *args):
+        """在工作线程中运行一个提取步骤；推理模式、autocast和当前CUDA流都是线程局部的，需在线程内设置"""
+        with self._inference_mode(), self._autocast(), self._stage_stream():
+            result = extract_fn(*args)
+            if self.device.type == 'cuda':
+                torch.cuda.current_stream(self.device).synchronize()
+            return result
+
+    def _gpu_flush(self, force=False):
+        """
+        按需释放缓存分配器中的空闲显存
+        
+        empty_cache 需要扫描并归还所有空闲块，分配模式稳定时每个分块都调用反而拖慢吞吐，
+        因此只在碎片率（已保留但未分配的比例）超过一半、或连续若干分块未释放时才执行
+        """
+        if self.device.type != 'cuda':
+            return
+        self._chunks_since_flush += 1
+        reserved = torch.cuda.memory_reserved(self.device)
+        fragmentation = 1 - torch.cuda.memory_allocated(self.device) / max(1, reserved)
+        if force or fragmentation > 0.5 or self._chunks_since_flush >= self.flush_interval:
+            gc.collect()
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
+            self._chunks_since_flush = 0
+
+    def _run_batched(self, extract_fn, *args, **kwargs):
+        """以 self.batch_size 调用模型，遇到显存不足时批大小减半后重试"""
+        while True:
+            try:
+                return extract_fn(*args, batch_size=self.batch_size, **kwargs)
+            except RuntimeError as e:
+                # torch.cuda.OutOfMemoryError 是 RuntimeError 的子类
+                if "out of memory" not in str(e) or self.batch_size == 1:
+                    raise
+                self.batch_size = max(1, self.batch_size // 2)
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                if self.verbose:
+                    print(f"⚠️ 显存不足，批大小降为 {self.batch_size}")
+
+    def _extract_figures_from_pdf(self, pdf_path, pages, first_page, output_bbox):
+        """提取图片信息（带图像），结果同时作为分子、反应和共指关系模型的输入"""
         try:
-            # 从图片中提取分子 - 修正参数名
-            molecules_from_figures = self.model.extract_molecules_from_figures_in_pdf(pdf_path)
-            
-            # 从文本中提取分子  
-            molecules_from_text = self.model.extract_molecules_from_text_in_pdf(pdf_path)
-            
-            return {
-                "from_figures": molecules_from_figures,
-                "from_text": molecules_from_text
-            }
+            return self.model.extract_figures_from_pdf(
+                pdf_path, output_bbox=output_bbox, output_image=True,
+                pages=pages, first_page=first_page
+            )
         except Exception as e:
             if self.verbose:
-                print(f"⚠️ 分子提取警告: {e}")
-            return {"from_figures": [], "from_text": []}
+                print(f"⚠️ 图片提取警告: {e}")
+            return []
 
-    def _extract_reactions_from_pdf(self, pdf_path, output_bbox):
-        """提取反应信息"""
+    def _strip_figure_images(self, figures):
+        """不输出图片时，去掉图片数据中的图像（复制后修改，不影响模型输入）"""
+        return [{**fig, "figure": {**fig["figure"], "image": None}} for fig in figures]
+
+    def _strip_molecule_images(self, molecules):
+        """不输出图片时，去掉分子的裁剪图像，避免整篇文档的图像数组保留到结果组装"""
+        return [{**mol, "image": None} for mol in molecules]
+
+    def _extract_molecules_from_figures(self, figures):
+        """从图片中提取分子信息"""
         try:
-            # 修正参数名
-            reactions = self.model.extract_reactions_from_figures_in_pdf(pdf_path)
-            return reactions
+            return self._run_batched(
+                self.model.extract_all_from_figures, figures, tasks=("molecules",)
+            )["molecules"]
         except Exception as e:
             if self.verbose:
-                print(f"⚠️ 反应提取警告: {e}")
+                print(f"⚠️ 分子提取警告: {e}")
             return []
 
-    def _extract_figures_from_pdf(self, pdf_path, output_bbox, output_images):
-        """提取图片信息"""
+    def _extract_molecules_from_text(self, pdf_path):
+        """从文本中提取分子信息"""
         try:
-            # 修正参数名
-            figures = self.model.extract_figures_from_pdf(
-                pdf_path, output_bbox=output_bbox, output_image=output_images
+            return self._run_batched(
+                self.model.extract_molecules_from_text_in_pdf, pdf_path
             )
-            return figures
         except Exception as e:
             if self.verbose:
-                print(f"⚠️ 图片提取警告: {e}")
+                print(f"⚠️ 分子提取警告: {e}")
             return []
 
-    def _extract_tables_from_pdf(self, pdf_path, output_bbox):
+    def _extract_reactions_from_figures(self, figures):
+        """提取反应信息"""
+        try:
+            return self._run_batched(
+                self.model.extract_all_from_figures, figures, tasks=("reactions",)
+            )["reactions"]
+        except Exception as e:
+            if self.verbose:
+                print(f"⚠️ 反应提取警告: {e}")
+            return []
+
+    def _extract_tables_from_pdf(self, pdf_path, pages, first_page, output_bbox):
         """提取表格信息"""
         try:
             # 修正参数名
             tables = self.model.extract_tables_from_pdf(
-                pdf_path, output_bbox=output_bbox
+                pdf_path, output_bbox=output_bbox,
+                pages=pages, first_page=first_page
             )
             return tables
         except Exception as e:
@@ -242,11 +529,12 @@ class OpenChemIEExtractorV2:
                 print(f"⚠️ 表格提取警告: {e}")
             return []
 
-    def _extract_coreferences_from_pdf(self, pdf_path):
+    def _extract_coreferences_from_figures(self, figures):
         """提取共指关系"""
         try:
-            corefs = self.model.extract_molecule_corefs_from_figures_in_pdf(pdf_path)
-            return corefs
+            return self._run_batched(
+                self.model.extract_all_from_figures, figures, tasks=("corefs",)
+            )["corefs"]
         except Exception as e:
             if self.verbose:
                 print(f"⚠️ 共指关系提取警告: {e}")
@@ -274,40 +562,10 @@ class OpenChemIEExtractorV2:
         
     def _analyze_molecules(self, molecules_data):
         """分析和整合分子数据"""
-        all_molecules = []
-        
-        # 合并来自不同来源的分子
-        for mol_list in molecules_data.values():
-            all_molecules.extend(mol_list)
+        unique_molecules, source_distribution, total_mentions, all_confidences = self._collect_molecules(molecules_data)
         
-        # 去重并增强数据
-        unique_molecules = {}
-        molecule_id_counter = 1
-        for mol_data in all_molecules:
-            smiles = mol_data.get("smiles")
-            if not smiles:
-                continue
-            
-            if smiles not in unique_molecules:
-                unique_molecules[smiles] = self._enhance_molecule_data(mol_data, f"MOL-{molecule_id_counter}")
-                molecule_id_counter += 1
-            else:
-                # 合并提及次数和来源
-                unique_molecules[smiles]["mentions"].append({
-                    "source": mol_data.get("source", "unknown"),
-                    "confidence": self._normalize_confidence(mol_data.get("score")),
-                    "page": mol_data.get("page_number"),
-                    "bbox": mol_data.get("bbox")
-                })
-
         # 准备最终输出
         molecule_list = list(unique_molecules.values())
-        source_distribution = self._organize_molecules_by_source(molecules_data)
-        
-        # 提取所有置信度分数
-        all_confidences = [
-            mention["confidence"] for mol in molecule_list for mention in mol["mentions"] if mention["confidence"] is not None
-        ]
         
         # 提取所有分子量和LogP
         all_mw = [mol["properties"]["molecular_weight"] for mol in molecule_list if mol["properties"]["molecular_weight"] is not None]
@@ -315,22 +573,12 @@ class OpenChemIEExtractorV2:
 
         return {
             "total_unique_molecules": len(molecule_list),
-            "total_mentions": len(all_molecules),
+            "total_mentions": total_mentions,
             "source_distribution": source_distribution,
             "confidence_metrics": self._analyze_confidence_distribution(all_confidences),
             "property_summary": {
-                "molecular_weight": {
-                    "average": round(np.mean(all_mw), 2) if all_mw else 0,
-                    "std_dev": round(np.std(all_mw), 2) if all_mw else 0,
-                    "min": min(all_mw) if all_mw else 0,
-                    "max": max(all_mw) if all_mw else 0
-                },
-                "logP": {
-                    "average": round(np.mean(all_logp), 2) if all_logp else 0,
-                    "std_dev": round(np.std(all_logp), 2) if all_logp else 0,
-                    "min": min(all_logp) if all_logp else 0,
-                    "max": max(all_logp) if all_logp else 0
-                }
+                "molecular_weight": self._summarize_property(all_mw),
+                "logP": self._summarize_property(all_logp)
             },
             "molecule_list": molecule_list
         }
@@ -340,54 +588,89 @@ class OpenChemIEExtractorV2:
         if not scores:
             return {"average": 0, "std_dev": 0, "min": 0, "max": 0, "distribution_percentiles": {}}
         
+        # 转成数组后所有统计量都在NumPy内完成，三个分位数只需一次排序
+        a = np.asarray(scores, dtype=np.float64)
+        p25, p50, p75 = np.percentile(a, [25, 50, 75])
         return {
-            "average": round(np.mean(scores), 2),
-            "std_dev": round(np.std(scores), 2),
-            "min": round(min(scores), 2),
-            "max": round(max(scores), 2),
+            "average": round(float(a.mean()), 2),
+            "std_dev": round(float(a.std()), 2),
+            "min": round(float(a.min()), 2),
+            "max": round(float(a.max()), 2),
             "distribution_percentiles": {
-                "p25": round(np.percentile(scores, 25), 2),
-                "p50": round(np.percentile(scores, 50), 2),
-                "p75": round(np.percentile(scores, 75), 2)
+                "p25": round(float(p25), 2),
+                "p50": round(float(p50), 2),
+                "p75": round(float(p75), 2)
             }
         }
 
-    def _organize_molecules_by_source(self, molecules_data):
-        """按来源组织分子"""
+    def _summarize_property(self, values):
+        """转为一个数组后一次性计算均值、标准差和极值"""
+        if not values:
+            return {"average": 0, "std_dev": 0, "min": 0, "max": 0}
+        a = np.asarray(values, dtype=float)
+        return {
+            "average": round(float(a.mean()), 2),
+            "std_dev": round(float(a.std()), 2),
+            "min": float(a.min()),
+            "max": float(a.max())
+        }
+
+    def _collect_molecules(self, molecules_data):
+        """
+        单次遍历所有分子，同时完成按SMILES去重增强和按来源组织
         
+        Returns:
+            tuple: (按SMILES去重的分子字典, 按来源组织的分子, 提及总数, 所有非空置信度)
+        """
+        unique_molecules = {}
         source_distribution = {}
+        total_mentions = 0
+        all_confidences = []
         mol_id_counter = 1
         
         for source, mol_list in molecules_data.items():
+            total_mentions += len(mol_list)
             
             processed_mols = []
             
-            for mol in mol_list:
+            mols = [mol for mol in mol_list if mol.get("smiles")]
+            # 标准化置信度（整个来源一次性计算）
+            confidences = self._normalize_confidences([mol.get("score") for mol in mols])
+            # 分子裁剪图像是ndarray，与图片一样先编码为base64 PNG
+            images = self._encode_images([mol.get("image") for mol in mols])
+            
+            for mol, confidence, image in zip(mols, confidences, images):
                 
-                smiles = mol.get("smiles")
-                if not smiles: continue
+                smiles = mol["smiles"]
+                mol_get = mol.get
+                if confidence is not None:
+                    all_confidences.append(confidence)
+                
+                # 去重并增强数据，重复出现时合并提及次数和来源
+                mention = {
+                    "source": mol_get("source", "unknown"),
+                    "confidence": confidence,
+                    "page": mol_get("page_number"),
+                    "bbox": mol_get("bbox")
+                }
+                if smiles not in unique_molecules:
+                    unique_molecules[smiles] = self._enhance_molecule_data(mol, f"MOL-{len(unique_molecules) + 1}", mention)
+                else:
+                    unique_molecules[smiles]["mentions"].append(mention)
                 
                 # 为每个分子创建唯一的ID
                 mol_id = f"MOL-{mol_id_counter}"
                 mol_id_counter += 1
                 
-                # 标准化置信度
-                confidence = self._normalize_confidence(mol.get("score"))
-                
-                # 提取其他信息
-                page = mol.get("page_number", -1)
-                bbox = mol.get("bbox")
-                mol_image_b64 = mol.get("image") # 假设图片是base64编码
-                
                 # 创建分子对象
                 mol_object = {
                     "id": mol_id,
                     "smiles": smiles,
                     "source": source,
                     "confidence": confidence,
-                    "page": page,
-                    "bbox": bbox,
-                    "image_base64": mol_image_b64
+                    "page": mol_get("page_number", -1),
+                    "bbox": mol_get("bbox"),
+                    "image_base64": image
                 }
                 
                 processed_mols.append(mol_object)
@@ -396,51 +679,64 @@ class OpenChemIEExtractorV2:
                 "count": len(processed_mols),
                 "molecules": processed_mols
             }
+        
+        # 所有独立分子收集完后，再批量计算RDKit属性
+        descriptors = self._compute_descriptors_batch(list(unique_molecules))
+        for molecule, properties in zip(unique_molecules.values(), descriptors):
+            molecule["properties"] = properties
             
-        return source_distribution
-
+        return unique_molecules, source_distribution, total_mentions, all_confidences
 
-    def _enhance_molecule_data(self, mol_data, mol_id):
-        """使用RDKit计算分子属性并增强数据"""
-        smiles = mol_data.get("smiles")
+    @staticmethod
+    @lru_cache(maxsize=8192)
+    def _descriptors_for_smiles(smiles):
+        """计算分子属性，按SMILES缓存，同一分子在多篇文献或多个图中重复出现时不再重复解析"""
+        from rdkit import Chem
+        from rdkit.Chem import Descriptors, Crippen
+        
         mol = Chem.MolFromSmiles(smiles) if smiles else None
         
-        properties = {
-            "molecular_weight": None,
-            "formula": None,
-            "logP": None,
-            "num_h_donors": None,
-            "num_h_acceptors": None,
-            "num_rotatable_bonds": None
-        }
+        if not mol:
+            return {
+                "molecular_weight": None,
+                "formula": None,
+                "logP": None,
+                "num_h_donors": None,
+                "num_h_acceptors": None,
+                "num_rotatable_bonds": None
+            }
         
-        if mol:
-            properties["molecular_weight"] = round(Descriptors.MolWt(mol), 2)
-            properties["formula"] = Chem.rdMolDescriptors.CalcMolFormula(mol)
-            properties["logP"] = round(Crippen.MolLogP(mol), 2)
-            properties["num_h_donors"] = Descriptors.NumHDonors(mol)
-            properties["num_h_acceptors"] = Descriptors.NumHAcceptors(mol)
-            properties["num_rotatable_bonds"] = Descriptors.NumRotatableBonds(mol)
-            
+        return {
+            "molecular_weight": round(Descriptors.MolWt(mol), 2),
+            "formula": Chem.rdMolDescriptors.CalcMolFormula(mol),
+            "logP": round(Crippen.MolLogP(mol), 2),
+            "num_h_donors": Descriptors.NumHDonors(mol),
+            "num_h_acceptors": Descriptors.NumHAcceptors(mol),
+            "num_rotatable_bonds": Descriptors.NumRotatableBonds(mol)
+        }
+
+    def _compute_descriptors_batch(self, smiles_list):
+        """批量计算分子属性，返回与 smiles_list 顺序一致的属性字典列表"""
+        # RDKit 描述符计算耗时很短且不释放GIL，多线程只增加开销，按顺序经缓存计算
+        descriptors = map(self._descriptors_for_smiles, smiles_list)
+        # 缓存返回的是共享对象，复制后再放入结果
+        return [dict(properties) for properties in descriptors]
+
+    def _enhance_molecule_data(self, mol_data, mol_id, mention):
+        """增强分子数据，mention 为该分子的首次提及；分子属性由 _compute_descriptors_batch 批量填充"""
         return {
             "id": mol_id,
-            "smiles": smiles,
+            "smiles": mol_data.get("smiles"),
             "iupac_name": mol_data.get("iupac_name"), # 假设模型可以提取
-            "properties": properties,
-            "mentions": [{
-                "source": mol_data.get("source", "unknown"),
-                "confidence": self._normalize_confidence(mol_data.get("score")),
-                "page": mol_data.get("page_number"),
-                "bbox": mol_data.get("bbox")
-            }]
+            "properties": None,
+            "mentions": [mention]
         }
 
-    def _normalize_confidence(self, score):
-        """将置信度分数归一化到0-1范围"""
-        if score is None:
-            return None
+    def _normalize_confidences(self, scores):
+        """批量将置信度分数归一化到0-1范围，None 保持为 None"""
         # 假设分数已经是0-1范围，如果不是，需要调整
-        return round(float(score), 3)
+        a = np.array([np.nan if score is None else score for score in scores], dtype=np.float64)
+        return [None if c != c else c for c in np.round(a, 3).tolist()]
 
     def _analyze_reactions(self, reactions_data):
         """分析和格式化反应数据"""
@@ -453,27 +749,25 @@ class OpenChemIEExtractorV2:
     def _format_reactions(self, reactions_data):
         """格式化反应数据"""
         formatted_reactions = []
-        reaction_id_counter = 1
-        for rxn_data in reactions_data:
-            rxn_id = f"RXN-{reaction_id_counter}"
-            reaction_id_counter += 1
+        for reaction_id, rxn_data in enumerate(reactions_data, 1):
+            rxn_get = rxn_data.get
             
             # 提取参与物
-            reactants = [m["smiles"] for m in rxn_data.get("reactants", []) if m.get("smiles")]
-            products = [m["smiles"] for m in rxn_data.get("products", []) if m.get("smiles")]
+            reactants = [m["smiles"] for m in rxn_get("reactants", []) if m.get("smiles")]
+            products = [m["smiles"] for m in rxn_get("products", []) if m.get("smiles")]
             
             # 提取条件
-            conditions_text = [c.get("text") for c in rxn_data.get("conditions", [])]
+            conditions_text = [c.get("text") for c in rxn_get("conditions", [])]
             
             formatted_reactions.append({
-                "id": rxn_id,
+                "id": f"RXN-{reaction_id}",
                 "reaction_smiles": f"{'.'.join(reactants)}>>{'.'.join(products)}",
                 "reactants_smiles": reactants,
                 "products_smiles": products,
                 "conditions": conditions_text,
                 "source": {
-                    "page": rxn_data.get("page_number"),
-                    "bbox": rxn_data.get("bbox")
+                    "page": rxn_get("page_number"),
+                    "bbox": rxn_get("bbox")
                 }
             })
         return formatted_reactions
@@ -488,18 +782,33 @@ class OpenChemIEExtractorV2:
             "tables": formatted_tables
         }
 
+    def _get_text(self, value):
+        """取标题/脚注文本：output_bbox 时为 {'text', 'bbox'} 字典，否则为纯字符串"""
+        try:
+            return value.get("text", "")
+        except AttributeError:
+            return value or ""
+
+    def _encode_images(self, images):
+        """将一组图像编码为base64 PNG字符串，None 保持为 None"""
+        # PNG压缩为纯CPU计算，PIL编码时会释放GIL，多线程并行编码所有图片
+        if not any(image is not None for image in images):
+            return images
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            return list(executor.map(_encode_png_base64, images))
+
     def _format_figures_data(self, figures_data):
         """格式化图片数据"""
         formatted_figures = []
-        figure_id_counter = 1
         
-        for fig_data in figures_data:
-            fig_id = f"FIG-{figure_id_counter}"
-            figure_id_counter += 1
+        images = self._encode_images([fig_data.get("figure", {}).get("image") for fig_data in figures_data])
+        
+        for figure_id, (fig_data, image) in enumerate(zip(figures_data, images), start=1):
+            fig_id = f"FIG-{figure_id}"
             
             # 提取标题和脚注
-            caption = fig_data.get("title", {}).get("text", "")
-            footnote = fig_data.get("footnote", {}).get("text", "")
+            caption = self._get_text(fig_data.get("title"))
+            footnote = self._get_text(fig_data.get("footnote"))
             
             # 提取图片信息
             image_info = fig_data.get("figure", {})
@@ -510,7 +819,7 @@ class OpenChemIEExtractorV2:
                 "bbox": image_info.get("bbox"),
                 "caption": caption,
                 "footnote": footnote,
-                "image_base64": image_info.get("image") # 假设是base64
+                "image_base64": image
             })
             
         return formatted_figures
@@ -518,15 +827,13 @@ class OpenChemIEExtractorV2:
     def _format_tables_data(self, tables_data):
         """格式化表格数据"""
         formatted_tables = []
-        table_id_counter = 1
         
-        for tbl_data in tables_data:
-            tbl_id = f"TBL-{table_id_counter}"
-            table_id_counter += 1
+        for table_id, tbl_data in enumerate(tables_data, start=1):
+            tbl_id = f"TBL-{table_id}"
             
             # 提取标题和脚注
-            title = tbl_data.get("title", {}).get("text", "")
-            footnote = tbl_data.get("footnote", {}).get("text", "")
+            title = self._get_text(tbl_data.get("title"))
+            footnote = self._get_text(tbl_data.get("footnote"))
             
             # 提取表格内容
             table_content = tbl_data.get("table", {})
@@ -552,16 +859,15 @@ class OpenChemIEExtractorV2:
 
     def _format_table_structure(self, content):
         """格式化表格结构"""
-        columns = content.get("columns", [])
-        
-        formatted_columns = []
-        for i, col in enumerate(columns):
-            formatted_columns.append({
+        formatted_columns = [
+            {
                 "index": i,
                 "header": col.get("text", ""),
                 "semantic_role": self._get_semantic_role(col.get("tag")),
                 "data_type": self._classify_column_type(col.get("tag")) # 初步分类
-            })
+            }
+            for i, col in enumerate(content.get("columns", []))
+        ]
             
         return {
             "num_columns": len(formatted_columns),
@@ -571,95 +877,74 @@ class OpenChemIEExtractorV2:
         
     def _classify_column_type(self, tag):
         """根据标签初步分类列数据类型"""
-        numeric_tags = ["measurement", "temperature", "time", "result", "ratio"]
-        if tag in numeric_tags:
+        if tag in _NUMERIC_TAGS:
             return "numeric"
-        
-        categorical_tags = ["substance", "alkyl group", "solvent", "catalyst"]
-        if tag in categorical_tags:
+        if tag in _CATEGORICAL_TAGS:
             return "categorical"
             
         return "text"
         
     def _get_semantic_role(self, tag):
         """获取列的语义角色"""
-        role_mapping = {
-            "substance": "Reactant/Product",
-            "reactant": "Reactant",
-            "product": "Product",
-            "catalyst": "Catalyst",
-            "solvent": "Solvent",
-            "temperature": "Condition-Temperature",
-            "time": "Condition-Time",
-            "yield": "Result-Yield",
-            "ee": "Result-EnantiomericExcess",
-            "ratio": "Stoichiometry"
-        }
-        return role_mapping.get(tag, "unknown")
+        return _SEMANTIC_ROLES.get(tag, "unknown")
 
     def _format_table_data(self, content):
         """格式化表格数据"""
         rows = content.get("rows", [])
         columns = content.get("columns", [])
         
+        # 列名对每一行都相同，只计算一次
+        headers = [column.get("text", f"col_{col_idx}") for col_idx, column in enumerate(columns)]
+        
         formatted_rows = []
-        for row_idx, row in enumerate(rows):
+        for row in rows:
             formatted_row = {}
             for col_idx, cell in enumerate(row):
-                header = columns[col_idx].get("text", f"col_{col_idx}")
+                header = headers[col_idx]
                 cell_text = cell.get("text", "")
                 
                 # 分析单元格内容
                 cell_type = self._classify_cell_type(cell_text)
                 
-                cell_data = {
-                    "raw_text": cell_text,
-                    "type": cell_type
-                }
-                
                 if cell_type == "numeric":
-                    cell_data["value"] = self._extract_numeric_value(cell_text)
-                    cell_data["unit"] = self._extract_unit(cell_text)
-                
-                formatted_row[header] = cell_data
+                    value, unit = self._extract_value_and_unit(cell_text)
+                    formatted_row[header] = {
+                        "raw_text": cell_text,
+                        "type": cell_type,
+                        "value": value,
+                        "unit": unit
+                    }
+                else:
+                    formatted_row[header] = {
+                        "raw_text": cell_text,
+                        "type": cell_type
+                    }
                 
             formatted_rows.append(formatted_row)
             
         return formatted_rows
 
-    def _classify_cell_type(self, text):
-        """分类单元格数据类型"""
-        if self._is_numeric(text):
+    @staticmethod
+    @lru_cache(maxsize=8192)
+    def _classify_cell_type(text):
+        """分类单元格数据类型，按文本缓存，表格中大量重复的单元格（产率、温度等）只匹配一次"""
+        text = text.strip()
+        if _NUMERIC_CELL_PATTERN.match(text) or _RANGE_CELL_PATTERN.search(text):
             return "numeric"
         return "text"
 
-    def _is_numeric(self, text):
-        """判断字符串是否为数值"""
-        # 匹配整数、小数、科学计数法、范围
-        # 更宽松的匹配，允许结尾有单位
-        numeric_pattern = re.compile(r"^[-\u2212\s]*(\d{1,3}(,\d{3})*|\d+)(\.\d*)?([eE][+-]?\d+)?.*")
-        range_pattern = re.compile(r".*(\d+\s*-\s*\d+).*") # 如 "10-20"
-        
-        if numeric_pattern.match(text.strip()) or range_pattern.match(text.strip()):
-            return True
-        return False
-
-    def _extract_numeric_value(self, text):
-        """提取数值"""
+    @staticmethod
+    @lru_cache(maxsize=8192)
+    def _extract_value_and_unit(text):
+        """一次匹配同时提取数值和单位，按文本缓存"""
         # 移除逗号分隔符
         text = text.replace(",", "")
-        # 匹配浮点数或整数
-        match = re.search(r"[-−\s]*\d+(\.\d*)?", text)
-        return float(match.group(0).replace("−", "-")) if match else None
-        
-    def _extract_unit(self, text):
-        """提取单位"""
+        match = _NUMBER_PATTERN.search(text)
+        if not match:
+            return None, None
         # 移除数值部分后，剩余部分作为单位
         # 这是一个简化方法，可能需要更复杂的逻辑
-        numeric_part = re.search(r"[-−\s]*\d+(\.\d*)?", text)
-        if numeric_part:
-            return text[numeric_part.end():].strip()
-        return None
+        return float(match.group(0).replace("−", "-")), text[match.end():].strip()
 
     def _build_relationships(self, corefs_data, molecules_data):
         """构建关系部分"""
@@ -674,21 +959,8 @@ class OpenChemIEExtractorV2:
 
     def _format_coreferences(self, corefs_data, molecules_data):
         """格式化共指关系"""
-        
-        # 1. 创建一个SMILES到分子ID的映射
-        smiles_to_id = {}
-        for source, mol_list in molecules_data.items():
-            for mol in mol_list:
-                smiles = mol.get("smiles")
-                if smiles and smiles not in smiles_to_id:
-                    # 假设分子ID在_enhance_molecule_data中已创建
-                    # 这里我们需要一个方式来获取那个ID
-                    # 简化：暂时只用SMILES作为键
-                    pass 
-
-        # 2. 处理共指链
+        # 提及暂时只用SMILES关联分子，还没有SMILES到分子ID的映射
         clusters = []
-        cluster_id_counter = 1
         
         if not isinstance(corefs_data, dict):
             return []
@@ -698,27 +970,21 @@ class OpenChemIEExtractorV2:
             if not isinstance(coref_chains, list): continue
 
             for chain in coref_chains:
-                cluster_id = f"COREF-{cluster_id_counter}"
-                cluster_id_counter += 1
-                
-                mentions = []
+                cluster_id = f"COREF-{len(clusters) + 1}"
                 
                 # 代表性提及 (通常是第一个)
                 representative_smiles = chain[0].get("smiles")
                 
-                for mention_data in chain:
-                    # 获取提及的分子ID
-                    # 这里需要一个更可靠的机制来关联
-                    # 暂时使用SMILES来查找
-                    mention_smiles = mention_data.get("smiles")
-                    
+                mentions = []
+                for mention_idx, mention_data in enumerate(chain, 1):
+                    mention_get = mention_data.get
                     mentions.append({
-                        "mention_id": f"MENTION-{len(mentions)+1}",
-                        "molecule_smiles": mention_smiles,
-                        "text_mention": mention_data.get("text"),
+                        "mention_id": f"MENTION-{mention_idx}",
+                        "molecule_smiles": mention_get("smiles"),
+                        "text_mention": mention_get("text"),
                         "source": {
-                            "page": mention_data.get("page_number"),
-                            "bbox": mention_data.get("bbox")
+                            "page": mention_get("page_number"),
+                            "bbox": mention_get("bbox")
                         }
                     })
                 
@@ -733,11 +999,11 @@ class OpenChemIEExtractorV2:
     def _calculate_quality_metrics(self, molecules_data, reactions_data, tables_data, corefs_data):
         """计算提取质量指标"""
         # 分子置信度
-        mol_scores = [
-            self._normalize_confidence(m.get("score")) 
+        mol_scores = self._normalize_confidences([
+            m.get("score")
             for m_list in molecules_data.values() 
             for m in m_list if m.get("score") is not None
-        ]
+        ])
         
         # 反应置信度 - 假设有
         rxn_scores = [
@@ -756,23 +1022,19 @@ class OpenChemIEExtractorV2:
             "completeness_score": round(np.mean([1 if mol_scores else 0, 1 if reactions_data else 0, 1 if tables_data else 0]), 2)
         }
 
-    def _calculate_statistics(self, results, processing_time):
-        """计算最终统计数据"""
+    def _calculate_statistics(self, counts, processing_time):
+        """计算最终统计数据，counts 为组装结果时得到的各项计数"""
+        # 只在统计时用到，延迟导入以减少模块加载时间
+        import psutil
+        
         stats = {
             "total_processing_time_seconds": processing_time,
             "performance": {
-                "pages_per_second": round(results["metadata"]["document_info"]["total_pages"] / processing_time, 2) if processing_time > 0 else 0,
-                "cpu_usage_percent": psutil.cpu_percent(),
+                "pages_per_second": round(counts["total_pages"] / processing_time, 2) if processing_time > 0 else 0,
+                "cpu_usage_percent": psutil.cpu_percent(interval=None),
                 "memory_usage_gb": round(psutil.virtual_memory().used / (1024**3), 2)
             },
-            "counts": {
-                "total_pages": results["metadata"]["document_info"]["total_pages"],
-                "total_figures": results["document_structure"]["total_figures"],
-                "total_tables": results["document_structure"]["total_tables"],
-                "total_unique_molecules": results["chemical_entities"]["molecules"]["total_unique_molecules"],
-                "total_reactions": results["chemical_entities"]["reactions"]["total_reactions"],
-                "total_coref_clusters": results["relationships"]["coreferences"]["total_clusters"]
-            }
+            "counts": counts
         }
         return stats
 
@@ -787,6 +1049,24 @@ class OpenChemIEExtractorV2:
         print(f"🔗 发现了 {stats['total_coref_clusters']} 个共指链")
         print("="*55)
         
+    def to_json_bytes(self, results):
+        """
+        将提取结果序列化为JSON字节串（UTF-8，无缩进）
+        
+        Args:
+            results (dict): 提取结果
+            
+        Returns:
+            bytes: JSON字节串
+        """
+        return _dumps(results)
+
+    def close(self):
+        """关闭渲染进程池；提取器不再使用时调用"""
+        if self._render_pool is not None:
+            self._render_pool.shutdown()
+            self._render_pool = None
+
     def save_results(self, results, output_path):
         """
         将提取结果保存为JSON文件
@@ -794,50 +1074,94 @@ class OpenChemIEExtractorV2:
         Args:
             results (dict): 提取结果
             output_path (str): 输出文件路径 (JSON)
+            
+        Returns:
+            bytes: 写入文件的JSON字节串，调用方可直接复用，无需再次序列化或读回文件
         """
         output_dir = os.path.dirname(output_path)
         if output_dir:
             os.makedirs(output_dir, exist_ok=True)
             
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False, indent=4)
+        # 一次性序列化后以二进制写入，安装了orjson时比json.dump快得多
+        data = _dumps(results, indent=True)
+        with open(output_path, 'wb') as f:
+            f.write(data)
         
         if self.verbose:
             print(f"💾 结果已保存至: {output_path}")
+        return data
 
-def main():
-    """主函数，用于命令行操作"""
+
+# 兼容旧名称
+OpenChemIEExtractor = OpenChemIEExtractorV2
+
+
+def _build_parser():
+    """构建命令行参数解析器"""
+    import argparse
+    
     parser = argparse.ArgumentParser(description="OpenChemIE v2.0 - 从PDF中提取化学信息")
-    parser.add_argument("pdf_path", type=str, help="输入的PDF文件路径")
-    parser.add_argument("-o", "--output", type=str, default=None, help="输出的JSON文件路径")
+    parser.add_argument("pdf_paths", type=str, nargs="+", help="输入的PDF文件路径，可传入多个；传入目录时处理其中全部PDF")
+    parser.add_argument("-o", "--output", type=str, default=None, help="输出的JSON文件路径（传入多个PDF时为输出目录）")
     parser.add_argument("--no-images", action="store_true", help="不输出提取的图片")
     parser.add_argument("--no-bbox", action="store_true", help="不输出边界框信息")
     parser.add_argument("--no-corefs", action="store_true", help="不提取共指关系")
     parser.add_argument("--device", type=str, default=None, help="计算设备 (例如 'cuda:0' 或 'cpu')")
     parser.add_argument("-q", "--quiet", action="store_true", help="安静模式，不打印详细信息")
+    return parser
+
+def _run(args, extractor_cls=OpenChemIEExtractorV2):
+    """按解析后的参数提取并保存结果"""
+    # 目录参数展开为其中的PDF文件，os.scandir 直接给出文件类型，无需逐个stat
+    pdf_paths = []
+    for path in args.pdf_paths:
+        if os.path.isdir(path):
+            with os.scandir(path) as entries:
+                pdf_paths.extend(sorted(
+                    entry.path for entry in entries
+                    if entry.is_file() and entry.name.lower().endswith(".pdf")
+                ))
+        else:
+            pdf_paths.append(path)
     
-    args = parser.parse_args()
-    
-    # 初始化提取器
-    extractor = OpenChemIEExtractorV2(device=args.device, verbose=not args.quiet)
-    
-    # 提取信息
-    results = extractor.extract_from_pdf(
-        args.pdf_path,
-        output_images=not args.no_images,
-        output_bbox=not args.no_bbox,
-        extract_corefs=not args.no_corefs
-    )
+    # 初始化提取器，多个PDF共用同一份模型
+    extractor = extractor_cls(device=args.device, verbose=not args.quiet)
     
-    # 保存结果
-    if args.output:
-        output_path = args.output
-    else:
-        # 自动生成输出文件名
-        base_name = Path(args.pdf_path).stem
-        output_path = f"{base_name}_openchemie_results.json"
-        
-    extractor.save_results(results, output_path)
+    # 结果在后台线程写盘，与下一个PDF的推理重叠
+    try:
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending = []
+            for pdf_path in pdf_paths:
+                # 提取信息
+                results = extractor.extract_from_pdf(
+                    pdf_path,
+                    output_images=not args.no_images,
+                    output_bbox=not args.no_bbox,
+                    extract_corefs=not args.no_corefs
+                )
+            
+                # 自动生成输出文件名
+                output_name = f"{Path(pdf_path).stem}_openchemie_results.json"
+                if args.output and len(pdf_paths) == 1 and not os.path.isdir(args.output):
+                    output_path = args.output
+                elif args.output:
+                    output_path = os.path.join(args.output, output_name)
+                else:
+                    output_path = output_name
+            
+                # 保存结果
+                pending.append(writer.submit(extractor.save_results, results, output_path))
+                del results
+        
+            # 写盘出错时在这里抛出
+            for future in pending:
+                future.result()
+    finally:
+        extractor.close()
+
+def main():
+    """主函数，用于命令行操作"""
+    _run(_build_parser().parse_args())
 
 if __name__ == '__main__':
     main()
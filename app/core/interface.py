@@ -1,8 +1,6 @@
 import torch
 import re
-from functools import lru_cache
 import layoutparser as lp
-import pdf2image
 from PIL import Image
 from huggingface_hub import hf_hub_download, snapshot_download
 from molscribe import MolScribe
@@ -38,7 +36,6 @@ class OpenChemIE:
             self.init_molscribe()
         return self._molscribe
 
-    @lru_cache(maxsize=None)
     def init_molscribe(self, ckpt_path=None):
         """
         Set model to custom checkpoint
@@ -56,7 +53,6 @@ class OpenChemIE:
             self.init_rxnscribe()
         return self._rxnscribe
 
-    @lru_cache(maxsize=None)
     def init_rxnscribe(self, ckpt_path=None):
         """
         Set model to custom checkpoint
@@ -74,7 +70,6 @@ class OpenChemIE:
             self.init_pdfparser()
         return self._pdfparser
 
-    @lru_cache(maxsize=None)
     def init_pdfparser(self, ckpt_path=None):
         """
         Set model to custom checkpoint
@@ -91,7 +86,6 @@ class OpenChemIE:
             self.init_moldet()
         return self._moldet
 
-    @lru_cache(maxsize=None)
     def init_moldet(self, ckpt_path=None):
         """
         Set model to custom checkpoint
@@ -109,7 +103,6 @@ class OpenChemIE:
             self.init_coref()
         return self._coref
 
-    @lru_cache(maxsize=None)
     def init_coref(self, ckpt_path=None):
         """
         Set model to custom checkpoint
@@ -127,7 +120,6 @@ class OpenChemIE:
             self.init_chemrxnextractor()
         return self._chemrxnextractor
 
-    @lru_cache(maxsize=None)
     def init_chemrxnextractor(self, ckpt_path=None):
         """
         Set model to custom checkpoint
@@ -145,7 +137,6 @@ class OpenChemIE:
             self.init_chemner()
         return self._chemner
 
-    @lru_cache(maxsize=None)
     def init_chemner(self, ckpt_path=None):
         """
         Set model to custom checkpoint
@@ -162,12 +153,14 @@ class OpenChemIE:
         return TableExtractor()
 
 
-    def extract_figures_from_pdf(self, pdf, num_pages=None, output_bbox=False, output_image=True):
+    def extract_figures_from_pdf(self, pdf, num_pages=None, output_bbox=False, output_image=True, pages=None, first_page=0):
         """
         Find and return all figures from a pdf page
         Parameters:
             pdf: path to pdf
             num_pages: process only first `num_pages` pages, if `None` then process all
+            pages: page images already rendered from `pdf` by get_pages_from_pdf, rendered here if `None`
+            first_page: index of the first pdf page to process, `pages[0]` is taken to be this page
             output_bbox: whether to output bounding boxes for each individual entry of a table
             output_image: whether to include PIL image for figures. default is True
         Returns:
@@ -192,7 +185,8 @@ class OpenChemIE:
                 # more figures
             ]
         """
-        pages = pdf2image.convert_from_path(pdf, last_page=num_pages)
+        if pages is None:
+            pages = get_pages_from_pdf(pdf, num_pages=num_pages, first_page=first_page)
 
         table_ext = self.tableextractor
         table_ext.set_pdf_file(pdf)
@@ -200,14 +194,16 @@ class OpenChemIE:
 
         table_ext.set_output_bbox(output_bbox)
         
-        return table_ext.extract_all_tables_and_figures(pages, self.pdfparser, content='figures')
+        return table_ext.extract_all_tables_and_figures(pages, self.pdfparser, content='figures', first_page=first_page)
 
-    def extract_tables_from_pdf(self, pdf, num_pages=None, output_bbox=False, output_image=True):
+    def extract_tables_from_pdf(self, pdf, num_pages=None, output_bbox=False, output_image=True, pages=None, first_page=0):
         """
         Find and return all tables from a pdf page
         Parameters:
             pdf: path to pdf
             num_pages: process only first `num_pages` pages, if `None` then process all
+            pages: page images already rendered from `pdf` by get_pages_from_pdf, rendered here if `None`
+            first_page: index of the first pdf page to process, `pages[0]` is taken to be this page
             output_bbox: whether to include bboxes for individual entries of the table
             output_image: whether to include PIL image for figures. default is True
         Returns:
@@ -232,7 +228,8 @@ class OpenChemIE:
                 # more tables
             ]
         """
-        pages = pdf2image.convert_from_path(pdf, last_page=num_pages)
+        if pages is None:
+            pages = get_pages_from_pdf(pdf, num_pages=num_pages, first_page=first_page)
 
         table_ext = self.tableextractor
         table_ext.set_pdf_file(pdf)
@@ -240,15 +237,17 @@ class OpenChemIE:
 
         table_ext.set_output_bbox(output_bbox)
         
-        return table_ext.extract_all_tables_and_figures(pages, self.pdfparser, content='tables')
+        return table_ext.extract_all_tables_and_figures(pages, self.pdfparser, content='tables', first_page=first_page)
 
-    def extract_molecules_from_figures_in_pdf(self, pdf, batch_size=16, num_pages=None):
+    def extract_molecules_from_figures_in_pdf(self, pdf, batch_size=16, num_pages=None, pages=None, first_page=0):
         """
         Get all molecules and their information from a pdf
         Parameters:
             pdf: path to pdf, or byte file
             batch_size: batch size for inference in all models
             num_pages: process only first `num_pages` pages, if `None` then process all
+            pages: page images already rendered from `pdf` by get_pages_from_pdf, rendered here if `None`
+            first_page: index of the first pdf page to process, `pages[0]` is taken to be this page
         Returns:
             A list of dictionaries, with each dictionary containing
             'smiles': SMILES string of the molecule
@@ -256,11 +255,9 @@ class OpenChemIE:
             'image': cropped image of the molecule
             'page': page number of the molecule
         """
-        if type(pdf) == str:
-            pages = pdf2image.convert_from_path(pdf, last_page=num_pages)
-        else:
-            pages = pdf2image.convert_from_bytes(pdf, last_page=num_pages)
-        figures = get_figures_from_pages(pages, self.pdfparser)
+        if pages is None:
+            pages = get_pages_from_pdf(pdf, num_pages=num_pages, first_page=first_page)
+        figures = get_figures_from_pages(pages, self.pdfparser, first_page=first_page)
         return self.extract_molecules_from_figures(figures, batch_size=batch_size)
     
     def extract_molecule_bboxes_from_figures(self, figures, batch_size=16):
@@ -270,6 +267,7 @@ class OpenChemIE:
             figures: a list of dictionaries, with each dictionary containing
             'image': image of the figure
             'page': page number of the figure
+            or figures as returned by extract_figures_from_pdf
             batch_size: batch size for inference in all models
         Returns:
             A list of dictionaries, with each dictionary corresponding to an image
@@ -277,7 +275,7 @@ class OpenChemIE:
             'bbox': bounding box of the molecule in the format of [x1, y1, x2, y2]
             'score': confidence score of the molecule detection
         """
-        images = [fig['image'] for fig in figures]
+        images = [get_figure_image(fig) for fig in figures]
         results = self.moldet.predict_images(images, batch_size=batch_size)
         return results
     
@@ -288,6 +286,7 @@ class OpenChemIE:
             figures: a list of dictionaries, with each dictionary containing
             'image': image of the figure
             'page': page number of the figure
+            or figures as returned by extract_figures_from_pdf
             batch_size: batch size for inference in all models
         Returns:
             A list of dictionaries, with each dictionary containing
@@ -296,7 +295,7 @@ class OpenChemIE:
             'image': cropped image of the molecule
             'page': page number of the molecule
         """
-        images = [np.asarray(fig['image']) for fig in figures]
+        images = [np.asarray(get_figure_image(fig)) for fig in figures]
         bboxes = self.extract_molecule_bboxes_from_figures(figures, batch_size=batch_size)
         results, cropped, references = clean_bbox_output(images, bboxes)
         smiles = self.molscribe.predict_images(cropped, batch_size=batch_size)
@@ -309,13 +308,15 @@ class OpenChemIE:
                 final_results.append(results[i]['molecules'][j])
         return final_results
     
-    def extract_molecule_corefs_from_figures_in_pdf(self, pdf, batch_size=16, num_pages=None, molscribe = True, ocr = True):
+    def extract_molecule_corefs_from_figures_in_pdf(self, pdf, batch_size=16, num_pages=None, molscribe = True, ocr = True, pages=None, first_page=0):
         """
         Get all molecules and their information from a pdf
         Parameters:
             pdf: path to pdf
             batch_size: batch size for inference in all models
             num_pages: process only first `num_pages` pages, if `None` then process all
+            pages: page images already rendered from `pdf` by get_pages_from_pdf, rendered here if `None`
+            first_page: index of the first pdf page to process, `pages[0]` is taken to be this page
             molscribe: whether to use molscribe to get SMILES strings
             ocr: whether to use ocr to get text
         Returns:
@@ -325,8 +326,9 @@ class OpenChemIE:
             'image': cropped image of the molecule
             'page': page number of the molecule
         """
-        pages = pdf2image.convert_from_path(pdf, last_page=num_pages)
-        figures = get_figures_from_pages(pages, self.pdfparser)
+        if pages is None:
+            pages = get_pages_from_pdf(pdf, num_pages=num_pages, first_page=first_page)
+        figures = get_figures_from_pages(pages, self.pdfparser, first_page=first_page)
         return self.extract_molecule_corefs_from_figures(figures, batch_size=batch_size, molscribe=molscribe, ocr=ocr)
         
     def extract_molecule_corefs_from_figures(self, figures, batch_size=16, molscribe=True, ocr=True):
@@ -336,6 +338,7 @@ class OpenChemIE:
             figures: a list of dictionaries, with each dictionary containing
             'image': image of the figure
             'page': page number of the figure
+            or figures as returned by extract_figures_from_pdf
             batch_size: batch size for inference in all models
             molscribe: whether to use molscribe to get SMILES strings
             ocr: whether to use ocr to get text
@@ -346,7 +349,7 @@ class OpenChemIE:
             'image': cropped image of the molecule
             'page': page number of the molecule
         """
-        images = [np.asarray(fig['image']) for fig in figures]
+        images = [np.asarray(get_figure_image(fig)) for fig in figures]
         results = self.coref.predict_images(images, batch_size=batch_size)
         if molscribe:
             mol_images = [elt['image'] for res in results for elt in res['mol_bboxes']]
@@ -363,13 +366,15 @@ class OpenChemIE:
                 result['text'] = self.molscribe.ocr.predict_images([images[i]], batch_size=batch_size)[0]
         return results
 
-    def extract_reactions_from_figures_in_pdf(self, pdf, batch_size=16, num_pages=None, molscribe=True, ocr=True):
+    def extract_reactions_from_figures_in_pdf(self, pdf, batch_size=16, num_pages=None, molscribe=True, ocr=True, pages=None, first_page=0):
         """
         Get all reactions and their information from a pdf
         Parameters:
             pdf: path to pdf
             batch_size: batch size for inference in all models
             num_pages: process only first `num_pages` pages, if `None` then process all
+            pages: page images already rendered from `pdf` by get_pages_from_pdf, rendered here if `None`
+            first_page: index of the first pdf page to process, `pages[0]` is taken to be this page
             molscribe: whether to use molscribe to get SMILES strings for molecules
             ocr: whether to use ocr to get text for other reaction components
         Returns:
@@ -384,7 +389,7 @@ class OpenChemIE:
                 'image': cropped image of the molecule
                 'page': page number of the molecule
         """
-        figures = self.extract_figures_from_pdf(pdf, num_pages=num_pages)
+        figures = self.extract_figures_from_pdf(pdf, num_pages=num_pages, pages=pages, first_page=first_page)
         results = self.extract_reactions_from_figures(figures, batch_size=batch_size, molscribe=molscribe, ocr=ocr)
         
         # for result in results:
@@ -424,6 +429,7 @@ class OpenChemIE:
             figures: a list of dictionaries, with each dictionary containing
             'image': image of the figure
             'page': page number of the figure
+            or figures as returned by extract_figures_from_pdf
             batch_size: batch size for inference in all models
             molscribe: whether to use molscribe to get SMILES strings for molecules
             ocr: whether to use ocr to get text for other reaction components
@@ -439,12 +445,39 @@ class OpenChemIE:
                 'image': cropped image of the molecule
                 'page': page number of the molecule
         """
-        images = [fig['image'] for fig in figures]
+        images = [get_figure_image(fig) for fig in figures]
         results = self.rxnscribe.predict_images(images, batch_size=batch_size, molscribe=molscribe, ocr=ocr)
         for result, figure in zip(results, figures):
             result['page'] = figure['page']
         return results
 
+    def extract_all_from_figures(self, figures, batch_size=16, molscribe=True, ocr=True, tasks=('molecules', 'reactions', 'corefs')):
+        """
+        Run several figure-level models over one shared list of figures, so that the pdf is
+        rendered and the figures are detected and cropped once rather than once per model
+        Parameters:
+            figures: figures as returned by extract_figures_from_pdf with output_image=True
+            batch_size: batch size for inference in all models
+            molscribe: whether to use molscribe to get SMILES strings
+            ocr: whether to use ocr to get text
+            tasks: which of 'molecules', 'reactions' and 'corefs' to run
+        Returns:
+            a dictionary with an entry for each requested task, in the format returned by
+            'molecules': extract_molecules_from_figures
+            'reactions': extract_reactions_from_figures_in_pdf
+            'corefs': extract_molecule_corefs_from_figures
+        """
+        results = {}
+        if 'molecules' in tasks:
+            results['molecules'] = self.extract_molecules_from_figures(figures, batch_size=batch_size)
+        if 'reactions' in tasks:
+            reactions = self.extract_reactions_from_figures(figures, batch_size=batch_size, molscribe=molscribe, ocr=ocr)
+            _ = [res.pop('diagram_bboxes', None) for res in reactions]
+            results['reactions'] = process_tables(figures, reactions, self.molscribe, batch_size=batch_size)
+        if 'corefs' in tasks:
+            results['corefs'] = self.extract_molecule_corefs_from_figures(figures, batch_size=batch_size, molscribe=molscribe, ocr=ocr)
+        return results
+
     def extract_molecules_from_text_in_pdf(self, pdf, batch_size=16, num_pages=None):
         """
         Get all molecules and their information from text in a pdf
@@ -527,12 +560,14 @@ class OpenChemIE:
 
         return result
     
-    def extract_reactions_from_figures_and_tables_in_pdf(self, pdf, num_pages=None, batch_size=16, molscribe=True, ocr=True):
+    def extract_reactions_from_figures_and_tables_in_pdf(self, pdf, num_pages=None, batch_size=16, molscribe=True, ocr=True, pages=None, first_page=0):
         """
         Get all reactions and their information from figures in a pdf
         Parameters:
             pdf: path to pdf
             num_pages: process only first `num_pages` pages, if `None` then process all
+            pages: page images already rendered from `pdf` by get_pages_from_pdf, rendered here if `None`
+            first_page: index of the first pdf page to process, `pages[0]` is taken to be this page
         Returns:
             a dictionary containing
             'reactions': a list of reactions, with each reaction a dictionary containing
@@ -551,19 +586,21 @@ class OpenChemIE:
         # for txt in text_blocks:
         #     print(txt)
         # return
-        figures = self.extract_figures_from_pdf(pdf, num_pages=num_pages)
+        figures = self.extract_figures_from_pdf(pdf, num_pages=num_pages, pages=pages, first_page=first_page)
         # for f in figures:
         #     print(f['page'])
         results = self.extract_reactions_from_figures(figures, batch_size=batch_size, molscribe=molscribe, ocr=ocr)
         return replace_rgroups_in_figure(figures, results, self.extract_molecule_corefs_from_figures(figures), self.molscribe, batch_size=batch_size)
 
 
-    def extract_reactions_from_pdf(self, pdf, num_pages=None, batch_size=16):
+    def extract_reactions_from_pdf(self, pdf, num_pages=None, batch_size=16, pages=None, first_page=0):
         """
         Get all reactions and their information from a pdf
         Parameters:
             pdf: path to pdf
             num_pages: process only first `num_pages` pages, if `None` then process all
+            pages: page images already rendered from `pdf` by get_pages_from_pdf, rendered here if `None`
+            first_page: index of the first pdf page to process, `pages[0]` is taken to be this page
         Returns:
             a dictionary containing
             'reactions': a list of reactions, with each reaction a dictionary containing
@@ -577,11 +614,13 @@ class OpenChemIE:
                 'page': page number of the molecule
         """
         results_from_text = self.extract_reactions_from_text_in_pdf(pdf, num_pages=num_pages)
-        figures = self.extract_figures_from_pdf(pdf, num_pages=num_pages)
+        figures = self.extract_figures_from_pdf(pdf, num_pages=num_pages, pages=pages, first_page=first_page)
         results_from_figures = self.extract_reactions_from_figures(figures, batch_size=batch_size)
-        results_from_figures = replace_rgroups_in_figure(figures, results_from_figures, self.extract_molecule_corefs_from_figures(figures), self.molscribe, batch_size=batch_size)
-        results = backout(results_from_figures, self.extract_molecule_corefs_from_figures(figures), self.molscribe)
-        #results = expand_reactions_with_backout(results_from_figures, self.extract_molecule_corefs_from_figures(figures), self.molscribe)
+        # coref results are only read downstream, so run the coref model once and share them
+        coref_results = self.extract_molecule_corefs_from_figures(figures, batch_size=batch_size)
+        results_from_figures = replace_rgroups_in_figure(figures, results_from_figures, coref_results, self.molscribe, batch_size=batch_size)
+        results = backout(results_from_figures, coref_results, self.molscribe)
+        #results = expand_reactions_with_backout(results_from_figures, coref_results, self.molscribe)
         # for res in results_from_figures:
         #     print(len(res['reactions']))
         #     if len(res['reactions']) > 0:
@@ -0,0 +1,70 @@
+# Page rendering for get_pages_from_pdf. Kept apart from utils.py, which pulls in
+# layoutparser, torch, RDKit and cv2 at import time: the spawned render workers only
+# import this module to unpickle _render_pages.
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+import numpy as np
+
+# PyMuPDF is not thread safe: every fitz call in the package, in any thread, holds this lock.
+# Worker processes each have their own copy, so rendering in the pool is not serialized.
+FITZ_LOCK = threading.Lock()
+
+def _open_pdf(pdf):
+    if isinstance(pdf, str):
+        return fitz.open(pdf)
+    return fitz.open(stream=pdf, filetype='pdf')
+
+def _render_pages(pdf, page_numbers, dpi, max_pixels=None):
+    # module level so that it can be sent to worker processes
+    with FITZ_LOCK, _open_pdf(pdf) as doc:
+        pages = []
+        for i in page_numbers:
+            page = doc[i]
+            zoom = dpi / 72
+            if max_pixels is not None:
+                # oversized pages are rendered at a lower dpi so they stay within max_pixels
+                zoom *= min(1.0, math.sqrt(max_pixels / (page.rect.width * page.rect.height * zoom ** 2)))
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            pages.append(np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n))
+    return pages
+
+def get_render_pool(num_workers):
+    """
+    Create a process pool for get_pages_from_pdf. It uses the spawn start method, since
+    forking a process that already runs worker threads (model stages, CUDA) can deadlock.
+    Create it once and reuse it across calls, preferably before starting any threads.
+    """
+    return ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'))
+
+def get_pages_from_pdf(pdf, num_pages=None, dpi=200, num_workers=1, first_page=0, max_pixels=None, executor=None):
+    """
+    Render the pages of a pdf, given as a path or bytes, to RGB arrays with PyMuPDF.
+    Pages from index first_page up to (not including) num_pages are rendered, so a long
+    document can be processed a chunk of pages at a time.
+    The default dpi matches what pdf2image used. If max_pixels is given, pages that would
+    be larger than that at dpi are scaled down to fit; TableExtractor reads the effective
+    dpi of each page off the image size.
+    PyMuPDF is not thread safe, so with num_workers > 1 contiguous page ranges are
+    rendered in separate processes, each opening its own copy of the document.
+    Pass a pool from get_render_pool as executor to reuse it across calls; otherwise a
+    spawn pool is started and torn down on every call, which is only worth it for large
+    page ranges.
+    """
+    with FITZ_LOCK, _open_pdf(pdf) as doc:
+        last_page = len(doc) if num_pages is None else min(num_pages, len(doc))
+    count = max(last_page - first_page, 0)
+    num_workers = min(num_workers or 1, count)
+    if num_workers <= 1:
+        return _render_pages(pdf, range(first_page, last_page), dpi, max_pixels)
+    chunks = [range(first_page + i * count // num_workers, first_page + (i + 1) * count // num_workers)
+              for i in range(num_workers)]
+    if executor is None:
+        with get_render_pool(num_workers) as pool:
+            return get_pages_from_pdf(pdf, num_pages, dpi, num_workers, first_page, max_pixels, executor=pool)
+    rendered = executor.map(_render_pages, [pdf] * num_workers, chunks, [dpi] * num_workers,
+                            [max_pixels] * num_workers)
+    return [page for chunk in rendered for page in chunk]
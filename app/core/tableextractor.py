@@ -1,21 +1,20 @@
-import pdf2image
 import numpy as np
 from PIL import Image
-import matplotlib.pyplot as plt
 import layoutparser as lp
 import cv2
-
-from PyPDF2 import PdfReader, PdfWriter
-import pandas as pd
+import fitz
+from .pdfrender import FITZ_LOCK
 
 import pdfminer.high_level
 import pdfminer.layout
 from operator import itemgetter
+from collections import defaultdict
 
 # inputs: pdf_file, page #, bounding box (optional) (llur or ullr), output_bbox
 class TableExtractor(object):
     def __init__(self, output_bbox=True):
         self.pdf_file = ""
+        self.page_geometry = None
         self.page = ""
         self.image_dpi = 200
         self.pdf_dpi = 72
@@ -46,13 +45,22 @@ class TableExtractor(object):
     
     def set_pdf_file(self, pdf):
         self.pdf_file = pdf
+        self.page_geometry = None
     
     def set_page_num(self, pn):
         self.page = pn
         
     def set_output_bbox(self, ob):
         self.output_bbox = ob
-        
+
+    def get_page_geometry(self):
+        # width and top edge of every page, read once under the shared fitz lock since the
+        # tables and figures stages run in different threads and fitz is not thread safe
+        if self.page_geometry is None:
+            with FITZ_LOCK, fitz.open(self.pdf_file) as doc:
+                self.page_geometry = [(page.rect.width, page.mediabox.y1) for page in doc]
+        return self.page_geometry
+
     def run_model(self, page_info):
         #img = np.asarray(pdf2image.convert_from_path(self.pdf_file, dpi=self.image_dpi)[self.page])
 
@@ -60,20 +68,17 @@ class TableExtractor(object):
         
         img = np.asarray(page_info)
         self.img = img
+        # pages capped by get_pages_from_pdf's max_pixels are rendered below the default dpi
+        self.image_dpi = img.shape[1] * self.pdf_dpi / self.get_page_geometry()[self.page][0]
         
         layout_result = self.model.detect(img)
         
-        text_blocks = lp.Layout([b for b in layout_result if b.type == 'Text'])
-        title_blocks = lp.Layout([b for b in layout_result if b.type == 'Title'])
-        list_blocks = lp.Layout([b for b in layout_result if b.type == 'List'])
-        table_blocks = lp.Layout([b for b in layout_result if b.type == 'Table'])
-        figure_blocks = lp.Layout([b for b in layout_result if b.type == 'Figure'])
+        buckets = defaultdict(list)
+        for b in layout_result:
+            buckets[b.type].append(b)
         
-        self.blocks.update({'text': text_blocks})
-        self.blocks.update({'title': title_blocks})
-        self.blocks.update({'list': list_blocks})
-        self.blocks.update({'table': table_blocks})
-        self.blocks.update({'figure': figure_blocks})
+        for block_type in ('Text', 'Title', 'List', 'Table', 'Figure'):
+            self.blocks.update({block_type.lower(): lp.Layout(buckets.get(block_type, []))})
     
     # type is what coordinates you want to get. it comes in text, title, list, table, and figure
     def convert_to_pdf_coordinates(self, type):
@@ -82,14 +87,10 @@ class TableExtractor(object):
         blocks = self.blocks[type]
         coordinates =  [blocks[a].scale(self.pdf_dpi/self.image_dpi) for a in range(len(blocks))]
         
-        reader = PdfReader(self.pdf_file)
-
-        writer = PdfWriter()
-        p = reader.pages[self.page]
-        a = p.mediabox.upper_left
+        top = self.get_page_geometry()[self.page][1]
         new_coords = []
         for new_block in coordinates:
-            new_coords.append((new_block.block.x_1, pd.to_numeric(a[1]) - new_block.block.y_2, new_block.block.x_2, pd.to_numeric(a[1]) - new_block.block.y_1))
+            new_coords.append((new_block.block.x_1, top - new_block.block.y_2, new_block.block.x_2, top - new_block.block.y_1))
         
         return new_coords
     # output: list of bounding boxes for tables but in pdf coordinates
@@ -322,12 +323,13 @@ class TableExtractor(object):
         return ret
     
     
-    def extract_all_tables_and_figures(self, pages, pdfparser, content=None):
+    def extract_all_tables_and_figures(self, pages, pdfparser, content=None, first_page=0):
+        # first_page is the pdf page index pages[0] was rendered from
         self.model = pdfparser
         ret = []
-        for i in range(len(pages)):
+        for i in range(first_page, first_page + len(pages)):
             self.set_page_num(i)
-            self.run_model(pages[i])
+            self.run_model(pages[i - first_page])
             tables_and_figures = []
             if content == 'tables':
                 tables_and_figures = self.extract_table_information()
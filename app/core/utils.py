@@ -1,6 +1,5 @@
 import numpy as np
 from PIL import Image
-import cv2
 import layoutparser as lp
 from rdkit import Chem
 from rdkit.Chem import Draw
@@ -8,8 +7,11 @@ from rdkit.Chem import rdDepictor
 rdDepictor.SetPreferCoordGen(True)
 from rdkit.Chem.Draw import IPythonConsole
 from rdkit.Chem import AllChem
+from rdkit import DataStructs
 import re
-import copy
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from .pdfrender import get_pages_from_pdf, get_render_pool
 
 BOND_TO_INT = {
     "": 0,
@@ -29,35 +31,99 @@ RGROUP_SYMBOLS = RGROUP_SYMBOLS + [f'[{i}]' for i in RGROUP_SYMBOLS]
 
 RGROUP_SMILES = ['[1*]', '[2*]','[3*]', '[4*]','[5*]', '[6*]','[7*]', '[8*]','[9*]', '[10*]','[11*]', '[12*]','[a*]', '[b*]','[c*]', '[d*]','*', '[Rf]']
 
-def get_figures_from_pages(pages, pdfparser):
+_RGROUP_PATTERN = re.compile(r'(?P<name>[RXY]\d?)\s*=\s*(?P<group>\w+)')
+_TABLE_PATTERN = re.compile(r'^(\w+-)?(?P<group>[\w-]+)( \(\w+\))?$')
+_COREF_PATTERN = re.compile(r'(?P<label>[\w\d.]+[abc]?)[,:]?\s+(?P<group>[\[\]\w\d-]+)')
+_STAR_LABEL_PATTERN = re.compile(r'\[\w*\*\]')
+
+_STAR_PATT = Chem.MolFromSmarts('[*]')
+
+# shared settings for the template substructure checks, which only need to know whether one match exists
+_SSS_PARAMS = Chem.SubstructMatchParameters()
+_SSS_PARAMS.useChirality = False
+_SSS_PARAMS.maxMatches = 1
+
+@lru_cache(maxsize=4096)
+def _mol_from_smiles(smiles):
+    # parsed molecules are shared between callers, so they must not be modified in place
+    return Chem.MolFromSmiles(smiles)
+
+@lru_cache(maxsize=4096)
+def _mol_from_smiles_star_as_c(smiles):
+    # r-group product with every dummy atom read as carbon, used as a substructure template
+    return _mol_from_smiles(smiles.replace('*', 'C'))
+
+def _packed_bits(fp):
+    # fingerprint bits packed into bytes, so that many fingerprints can be screened at once with NumPy
+    bits = np.zeros((fp.GetNumBits(),), dtype=np.uint8)
+    DataStructs.ConvertToNumpyArray(fp, bits)
+    return np.packbits(bits)
+
+@lru_cache(maxsize=4096)
+def _product_info(smiles, star_as_c=False):
+    # parsed product with its pattern fingerprint and heavy-atom count, shared by backout and expand_reactions_with_backout
+    # substructure screen: a match is only possible if the query's bits are a subset of the target's
+    mol = _mol_from_smiles_star_as_c(smiles) if star_as_c else _mol_from_smiles(smiles)
+    if mol is None:
+        return None
+    fp = Chem.PatternFingerprint(mol)
+    return mol, fp, mol.GetNumHeavyAtoms(), _packed_bits(fp)
+
+@lru_cache(maxsize=4096)
+def _canonical_smiles(smiles):
+    # parses its own copy, since writing SMILES stores properties on the molecule
+    mol = Chem.MolFromSmiles(smiles)
+    return smiles if mol is None else Chem.MolToSmiles(mol)
+
+def _reaction_key(rxn):
+    # canonical reaction SMILES, so equivalent expansions compare equal
+    return '>>'.join(
+        '.'.join(_canonical_smiles(mol['smiles']) if mol.get('smiles') else '' for mol in rxn[key])
+        for key in ('reactants', 'products'))
+
+@lru_cache(maxsize=4096)
+def _query_info(smiles):
+    # r-group product as a SMARTS query, with each dummy atom left as the any-atom wildcard
+    query = Chem.MolFromSmarts(_STAR_LABEL_PATTERN.sub('*', smiles))
+    if query is None:
+        return None
+    fp = Chem.PatternFingerprint(query)
+    return query, fp, query.GetNumHeavyAtoms(), _packed_bits(fp)
+
+def get_figures_from_pages(pages, pdfparser, first_page=0):
     figures = []
     for i in range(len(pages)):
         img = np.asarray(pages[i])
         layout = pdfparser.detect(img)
-        blocks = lp.Layout([b for b in layout if b.type == "Figure"])
-        for block in blocks:
-            figure = Image.fromarray(block.crop_image(img))
+        for block in layout:
+            if block.type != "Figure":
+                continue
             figures.append({
-                'image': figure,
-                'page': i
+                'image': Image.fromarray(block.crop_image(img)),
+                'page': first_page + i
             })
     return figures
 
+def get_figure_image(figure):
+    # figures from get_figures_from_pages hold the image at the top level, figures from
+    # extract_figures_from_pdf (TableExtractor) nest it under 'figure'
+    if 'figure' in figure:
+        return figure['figure']['image']
+    return figure['image']
+
 def clean_bbox_output(figures, bboxes):
     results = []
     cropped = []
     references = []
     for i, output in enumerate(bboxes):
-        mol_bboxes = [elt['bbox'] for elt in output if elt['category'] == '[Mol]']
-        mol_scores = [elt['score'] for elt in output if elt['category'] == '[Mol]']
+        mol_items = [(elt['bbox'], elt['score']) for elt in output if elt['category'] == '[Mol]']
         data = {}
         results.append(data)
         data['image'] = figures[i]
         data['molecules'] = []
-        for bbox, score in zip(mol_bboxes, mol_scores):
-            x1, y1, x2, y2 = bbox
-            height, width, _ = figures[i].shape
-            cropped_img = figures[i][int(y1*height):int(y2*height),int(x1*width):int(x2*width)]
+        coords = scale_bboxes([bbox for bbox, _ in mol_items], figures[i].shape)
+        for (bbox, score), (x1, y1, x2, y2) in zip(mol_items, coords):
+            cropped_img = figures[i][y1:y2, x1:x2]
             cur_mol = {
                 'bbox': bbox,
                 'score': score,
@@ -69,26 +135,39 @@ def clean_bbox_output(figures, bboxes):
             references.append(cur_mol)
     return results, cropped, references
     
+def scale_bboxes(bboxes, shape):
+    """
+    Converts normalized [x1, y1, x2, y2] bboxes to integer pixel coordinates of an image with the given shape
+    """
+    height, width = shape[:2]
+    scale = np.array([width, height, width, height], dtype=np.float64)
+    return (np.asarray(bboxes, dtype=np.float64).reshape(-1, 4) * scale).astype(np.int64)
+
+def swap_channels(image):
+    # reverses the channel order of a color image (BGR <-> RGB) as a strided view, without copying
+    if image.ndim == 3:
+        return image[..., 2::-1]
+    return image
+
 def convert_to_pil(image):
-    if type(image) == np.ndarray:
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image = Image.fromarray(image)
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(swap_channels(image))
     return image
 
 def convert_to_cv2(image):
-    if type(image) != np.ndarray:
-        image = cv2.cvtColor(np.array(image), cv2.COLOR_BGR2RGB)
+    if not isinstance(image, np.ndarray):
+        image = np.ascontiguousarray(swap_channels(np.asarray(image)))
     return image
 
 def replace_rgroups_in_figure(figures, results, coref_results, molscribe, batch_size=16):
-    pattern = re.compile('(?P<name>[RXY]\d?)[ ]*=[ ]*(?P<group>\w+)')
+    to_process = []
     for figure, result, corefs in zip(figures, results, coref_results):
         r_groups = []
         seen_r_groups = set()
         for bbox in corefs['bboxes']:
             if bbox['category'] == '[Idt]':
                 for text in bbox['text']:
-                    res = pattern.search(text)
+                    res = _RGROUP_PATTERN.search(text)
                     if res is None:
                         continue
                     name = res.group('name')
@@ -98,106 +177,138 @@ def replace_rgroups_in_figure(figures, results, coref_results, molscribe, batch_
                     seen_r_groups.add((name, group))
                     r_groups.append({name: res.group('group')})
         if r_groups and result['reactions']:
-            seen_r_groups = set([pair[0] for pair in seen_r_groups])
-            orig_reaction = result['reactions'][0]
-            graphs = get_atoms_and_bonds(figure['figure']['image'], orig_reaction, molscribe, batch_size=batch_size)
-            relevant_locs = {}
-            for i, graph in enumerate(graphs):
-                to_add = []
-                for j, atom in enumerate(graph['chartok_coords']['symbols']):
-                    if atom[1:-1] in seen_r_groups:
-                        to_add.append((atom[1:-1], j))
-                relevant_locs[i] = to_add
-
-            for r_group in r_groups:
-                reaction = get_replaced_reaction(orig_reaction, graphs, relevant_locs, r_group, molscribe)
-                to_add ={
-                    'reactants': reaction['reactants'][:],
-                    'conditions': orig_reaction['conditions'][:],
-                    'products': reaction['products'][:]
-                }
-                result['reactions'].append(to_add)
+            to_process.append((figure, result, r_groups, set([pair[0] for pair in seen_r_groups])))
+
+    all_graphs = get_atoms_and_bonds_for_figures(
+        [figure['figure']['image'] for figure, *_ in to_process],
+        [result['reactions'][0] for _, result, *_ in to_process],
+        molscribe, batch_size=batch_size)
+    for (figure, result, r_groups, seen_r_groups), graphs in zip(to_process, all_graphs):
+        orig_reaction = result['reactions'][0]
+        relevant_locs = {}
+        for i, graph in enumerate(graphs):
+            to_add = []
+            for j, atom in enumerate(graph['chartok_coords']['symbols']):
+                if atom[1:-1] in seen_r_groups:
+                    to_add.append((atom[1:-1], j))
+            relevant_locs[i] = to_add
+
+        reactions = get_replaced_reactions(orig_reaction, graphs, relevant_locs, r_groups, molscribe)
+        for reaction in reactions:
+            to_add ={
+                'reactants': reaction['reactants'],
+                'conditions': orig_reaction['conditions'],
+                'products': reaction['products']
+            }
+            result['reactions'].append(to_add)
     return results
 
 def process_tables(figures, results, molscribe, batch_size=16):
-    r_group_pattern = re.compile(r'^(\w+-)?(?P<group>[\w-]+)( \(\w+\))?$')
+    to_process = []
     for figure, result in zip(figures, results):
         result['page'] = figure['page']
         if figure['table']['content'] is not None:
-            content = figure['table']['content']
             if len(result['reactions']) > 1:
                 print("Warning: multiple reactions detected for table")
             elif len(result['reactions']) == 0:
                 continue
-            orig_reaction = result['reactions'][0]
-            graphs = get_atoms_and_bonds(figure['figure']['image'], orig_reaction, molscribe, batch_size=batch_size)
-            relevant_locs = find_relevant_groups(graphs, content['columns'])
-            conditions_to_extend = []
-            for row in content['rows']:
-                r_groups = {}
-                expanded_conditions = orig_reaction['conditions'][:]
-                replaced = False
-                for col, entry in zip(content['columns'], row):
-                    if col['tag'] != 'alkyl group':
-                        expanded_conditions.append({
-                            'category': '[Table]',
-                            'text': entry['text'], 
-                            'tag': col['tag'],
-                            'header': col['text'],
-                        })
-                    else:
-                        found = r_group_pattern.match(entry['text'])
-                        if found is not None:
-                            r_groups[col['text']] = found.group('group')
-                            replaced = True
-                reaction = get_replaced_reaction(orig_reaction, graphs, relevant_locs, r_groups, molscribe)  
-                if replaced:
-                    to_add = {
-                        'reactants': reaction['reactants'][:],
-                        'conditions': expanded_conditions,
-                        'products': reaction['products'][:]
-                    }
-                    result['reactions'].append(to_add)
+            to_process.append((figure, result))
+
+    all_graphs = get_atoms_and_bonds_for_figures(
+        [figure['figure']['image'] for figure, _ in to_process],
+        [result['reactions'][0] for _, result in to_process],
+        molscribe, batch_size=batch_size)
+    for (figure, result), graphs in zip(to_process, all_graphs):
+        content = figure['table']['content']
+        orig_reaction = result['reactions'][0]
+        relevant_locs = find_relevant_groups(graphs, content['columns'])
+        conditions_to_extend = []
+        replaced_rows = []
+        for row in content['rows']:
+            r_groups = {}
+            expanded_conditions = orig_reaction['conditions'][:]
+            replaced = False
+            for col, entry in zip(content['columns'], row):
+                if col['tag'] != 'alkyl group':
+                    expanded_conditions.append({
+                        'category': '[Table]',
+                        'text': entry['text'], 
+                        'tag': col['tag'],
+                        'header': col['text'],
+                    })
                 else:
-                    conditions_to_extend.append(expanded_conditions)
-            orig_reaction['conditions'] = [orig_reaction['conditions']]
-            orig_reaction['conditions'].extend(conditions_to_extend)
+                    found = _TABLE_PATTERN.match(entry['text'])
+                    if found is not None:
+                        r_groups[col['text']] = found.group('group')
+                        replaced = True
+            if replaced:
+                replaced_rows.append((r_groups, expanded_conditions))
+            else:
+                conditions_to_extend.append(expanded_conditions)
+        reactions = get_replaced_reactions(orig_reaction, graphs, relevant_locs, [r_groups for r_groups, _ in replaced_rows], molscribe)
+        for reaction, (_, expanded_conditions) in zip(reactions, replaced_rows):
+            to_add = {
+                'reactants': reaction['reactants'],
+                'conditions': expanded_conditions,
+                'products': reaction['products']
+            }
+            result['reactions'].append(to_add)
+        orig_reaction['conditions'] = [orig_reaction['conditions']]
+        orig_reaction['conditions'].extend(conditions_to_extend)
     return results
 
 
-def get_atoms_and_bonds(image, reaction, molscribe, batch_size=16):
+def crop_molecules(image, reaction):
     image = convert_to_cv2(image)
-    cropped_images = []
-    results = []
+    keys = []
+    bboxes = []
     for key, molecules in reaction.items():
         for i, elt in enumerate(molecules):
             if type(elt) != dict or elt['category'] != '[Mol]':
                 continue
-            x1, y1, x2, y2 = elt['bbox']
-            height, width, _ = image.shape
-            cropped_images.append(image[int(y1*height):int(y2*height),int(x1*width):int(x2*width)])
-            to_add = {
-                'image': cropped_images[-1],
-                'chartok_coords': {
-                    'coords': [],
-                    'symbols': [],
-                },
-                'edges': [],
-                'key': (key, i)
-            }
-            results.append(to_add)
-    outputs = molscribe.predict_images(cropped_images, return_atoms_bonds=True, batch_size=batch_size)
+            keys.append((key, i))
+            bboxes.append(elt['bbox'])
+    results = []
+    for key, (x1, y1, x2, y2) in zip(keys, scale_bboxes(bboxes, image.shape)):
+        to_add = {
+            'image': image[y1:y2, x1:x2],
+            'chartok_coords': {
+                'coords': [],
+                'symbols': [],
+            },
+            'edges': [],
+            'key': key
+        }
+        results.append(to_add)
+    return results
+
+def fill_atoms_and_bonds(results, outputs):
     for mol, result in zip(outputs, results):
         for atom in mol['atoms']:
             result['chartok_coords']['coords'].append((atom['x'], atom['y']))
             result['chartok_coords']['symbols'].append(atom['atom_symbol'])
-        result['edges'] = [[0] * len(mol['atoms']) for _ in range(len(mol['atoms']))]
-        for bond in mol['bonds']:
-            i, j = bond['endpoint_atoms']
-            result['edges'][i][j] = BOND_TO_INT[bond['bond_type']]
-            result['edges'][j][i] = BOND_TO_INT[bond['bond_type']]
+        n = len(mol['atoms'])
+        edges = np.zeros((n, n), dtype=np.int8)
+        if mol['bonds']:
+            ends = np.array([bond['endpoint_atoms'] for bond in mol['bonds']], dtype=np.intp).reshape(-1, 2)
+            types = np.array([BOND_TO_INT[bond['bond_type']] for bond in mol['bonds']], dtype=np.int8)
+            edges[ends[:, 0], ends[:, 1]] = types
+            edges[ends[:, 1], ends[:, 0]] = types
+        result['edges'] = edges
     return results
 
+def get_atoms_and_bonds(image, reaction, molscribe, batch_size=16):
+    return get_atoms_and_bonds_for_figures([image], [reaction], molscribe, batch_size=batch_size)[0]
+
+def get_atoms_and_bonds_for_figures(images, reactions, molscribe, batch_size=16):
+    # crop the molecules of every figure first so that molscribe runs once over all of them
+    all_graphs = [crop_molecules(image, reaction) for image, reaction in zip(images, reactions)]
+    graphs = [graph for figure_graphs in all_graphs for graph in figure_graphs]
+    if graphs:
+        outputs = molscribe.predict_images([graph['image'] for graph in graphs], return_atoms_bonds=True, batch_size=batch_size)
+        fill_atoms_and_bonds(graphs, outputs)
+    return all_graphs
+
 def find_relevant_groups(graphs, columns):
     results = {}
     r_groups = set([f"[{col['text']}]" for col in columns if col['tag'] == 'alkyl group'])
@@ -209,7 +320,7 @@ def find_relevant_groups(graphs, columns):
         results[i] = to_add
     return results
 
-def get_replaced_reaction(orig_reaction, graphs, relevant_locs, mappings, molscribe):
+def get_replaced_graphs(graphs, relevant_locs, mappings):
     graph_copy = []
     for graph in graphs:
         graph_copy.append({
@@ -218,60 +329,67 @@ def get_replaced_reaction(orig_reaction, graphs, relevant_locs, mappings, molscr
                 'coords': graph['chartok_coords']['coords'][:],
                 'symbols': graph['chartok_coords']['symbols'][:],
             },
-            'edges': graph['edges'][:],
+            'edges': graph['edges'].copy(),
             'key': graph['key'],
         })
     for graph_idx, atoms in relevant_locs.items():
         for atom, atom_idx in atoms:
             if atom in mappings:
                 graph_copy[graph_idx]['chartok_coords']['symbols'][atom_idx] = mappings[atom]
-    reaction_copy = {}
-    def append_copy(copy_list, entity):    
-        if entity['category'] == '[Mol]':
-            copy_list.append({
-                k1: v1 for k1, v1 in entity.items()
-            })
-        else:
-            copy_list.append(entity)
-
-    for k, v in orig_reaction.items():
-        reaction_copy[k] = []
-        for entity in v:
-            if type(entity) == list:
-                sub_list = []
-                for e in entity:
-                    append_copy(sub_list, e)
-                reaction_copy[k].append(sub_list)
-            else:
-                append_copy(reaction_copy[k], entity)
+    return graph_copy
 
-    for graph in graph_copy:
-        output = molscribe.convert_graph_to_output([graph], [graph['image']])
+def copy_entity(entity):
+    # molecules get their own dict because their smiles are filled in per reaction
+    return dict(entity) if entity['category'] == '[Mol]' else entity
+
+def fill_replaced_reaction(orig_reaction, graphs, outputs):
+    reaction_copy = {
+        k: [[copy_entity(e) for e in entity] if isinstance(entity, list) else copy_entity(entity) for entity in v]
+        for k, v in orig_reaction.items()
+    }
+
+    for graph, output in zip(graphs, outputs):
         molecule = reaction_copy[graph['key'][0]][graph['key'][1]]
-        molecule['smiles'] = output[0]['smiles']
+        molecule['smiles'] = output['smiles']
     return reaction_copy
 
+def get_replaced_reaction(orig_reaction, graphs, relevant_locs, mappings, molscribe):
+    return get_replaced_reactions(orig_reaction, graphs, relevant_locs, [mappings], molscribe)[0]
+
+def get_replaced_reactions(orig_reaction, graphs, relevant_locs, mappings_list, molscribe):
+    # substitute every mapping first so that molscribe converts all graphs in a single call
+    graph_copies = [get_replaced_graphs(graphs, relevant_locs, mappings) for mappings in mappings_list]
+    all_graphs = [graph for graph_copy in graph_copies for graph in graph_copy]
+    outputs = []
+    if all_graphs:
+        outputs = molscribe.convert_graph_to_output(all_graphs, [graph['image'] for graph in all_graphs])
+    reactions = []
+    offset = 0
+    for graph_copy in graph_copies:
+        reactions.append(fill_replaced_reaction(orig_reaction, graph_copy, outputs[offset:offset + len(graph_copy)]))
+        offset += len(graph_copy)
+    return reactions
+
 def get_sites(tar, ref, ref_site = False):
     """
     Returns sites for R-group substitution given a molecule to be substituted and a reference for substitution sites
     """
     if ref_site:
-        ref_mol_sites = Chem.MolFromSmiles(ref)
-        patt = Chem.MolFromSmarts('[*]')
-        sites = ref_mol_sites.GetSubstructMatches(patt)
+        ref_mol_sites = _mol_from_smiles(ref)
+        sites = ref_mol_sites.GetSubstructMatches(_STAR_PATT)
     else:
-        ref_mol = Chem.MolFromSmiles(ref)
+        ref_mol = _mol_from_smiles(ref)
         sites = tar.GetSubstructMatches(ref_mol)
     return sites
 
 
 def get_atom_mapping(prod_mol, prod_smiles, r_sites_reversed = None):
     # returns prod_mol_to_query which is the mapping of atom indices in prod_mol to the atom indices of the molecule represented by prod_smiles
-    prod_smi_mol = Chem.MolFromSmiles(prod_smiles)
+    prod_smi_mol = _mol_from_smiles(prod_smiles)
     if prod_smi_mol is None:
         return None, None, None, None
-    prod_smi_mol_no_r = Chem.MolFromSmiles(re.sub('\[\w*\*\]', '*', prod_smiles))
-    patt = Chem.MolFromSmiles('[*]')
+    prod_smi_mol_no_r = _mol_from_smiles(_STAR_LABEL_PATTERN.sub('*', prod_smiles))
+    patt = _mol_from_smiles('[*]')
     r_sites = prod_smi_mol.GetSubstructMatches(patt)
     if r_sites_reversed is None:
         r_sites_reversed = {}
@@ -289,7 +407,7 @@ def get_atom_mapping(prod_mol, prod_smiles, r_sites_reversed = None):
         # print(prod_smiles)
         # return None, None, None, None
         # return {}, {}, prod_mol, {}
-        prod_smi_mol = Chem.MolFromSmiles(prod_smiles)
+        prod_smi_mol = _mol_from_smiles(prod_smiles)
         prod_mol = Chem.AddHs(prod_mol)
         prod_smi_mol = Chem.AddHs(prod_smi_mol)
         prod_mol_substruct = prod_mol.GetSubstructMatches(prod_smi_mol)
@@ -312,29 +430,38 @@ def clean_corefs(coref_results_dict, idx):
     if len(coref_results_dict) <= idx:
         return None
     res = coref_results_dict[idx]
-    if 'mol_bboxes' not in res.keys():
+    if 'mol_bboxes' not in res:
         return None
     mol_bboxes_text = []
-    if 'smiles' in res['mol_bboxes'][0].keys():
+    if 'smiles' in res['mol_bboxes'][0]:
         mol_bboxes_text = [(bbox, bbox['smiles']) for bbox in res['mol_bboxes']]
 
-    if 'idt_bboxes' not in res.keys() or type(res['idt_bboxes']) is not list:
+    if 'idt_bboxes' not in res or type(res['idt_bboxes']) is not list:
         return None
     idt_bboxes_text = [bbox['text'] for bbox in res['idt_bboxes']]
     
-    patt = re.compile('(?P<label>[\w\d\.]+[abc]?)[,:]?[ ]+(?P<group>[\[\]\w\d-]+)')
     coref_smiles = {}
     for text in idt_bboxes_text:
-        found = patt.finditer(text)
+        found = _COREF_PATTERN.finditer(text)
         if found is not None:
             for f in found:
                 coref_smiles[f.group('label')] = f.group('group')
     return mol_bboxes_text, coref_smiles, res['bboxes']
 
+def get_fragment_atoms(mol, excluded):
+    # cut every bond of the excluded atoms and map each atom index to the atom indices of its fragment
+    bonds = sorted(set(bond.GetIdx() for idx in excluded for bond in mol.GetAtomWithIdx(idx).GetBonds()))
+    if bonds:
+        mol = Chem.FragmentOnBonds(mol, bonds, addDummies=False)
+    fragment_atoms = {}
+    for frag in Chem.GetMolFrags(mol):
+        for idx in frag:
+            fragment_atoms[idx] = frag
+    return fragment_atoms
+
 def expand_r_group_label_helper(res, coref_smiles_to_graphs, other_prod, molscribe):
-    other_prod_mol = Chem.MolFromSmiles(other_prod[1])
-    patt = Chem.MolFromSmarts('[*]')
-    match_indices = other_prod_mol.GetSubstructMatches(patt)
+    other_prod_mol = _mol_from_smiles(other_prod[1])
+    match_indices = other_prod_mol.GetSubstructMatches(_STAR_PATT)
 
     # for each match index, get connected components
     seen_idx = set()
@@ -344,16 +471,8 @@ def expand_r_group_label_helper(res, coref_smiles_to_graphs, other_prod, molscri
             continue
         seen_idx.add(match_idx)
         # get component
-        q = [other_prod_mol.GetAtomWithIdx(match_idx).GetNeighbors()[0].GetIdx()]
-        seen_q = set(q)
-        head = 0
-        while head < len(q):
-            cur = q[head]
-            head += 1
-            for neighbor in other_prod_mol.GetAtomWithIdx(cur).GetNeighbors():
-                if neighbor.GetIdx() not in seen_q and neighbor.GetIdx() not in seen_idx:
-                    q.append(neighbor.GetIdx())
-                    seen_q.add(neighbor.GetIdx())
+        start = other_prod_mol.GetAtomWithIdx(match_idx).GetNeighbors()[0].GetIdx()
+        q = list(get_fragment_atoms(other_prod_mol, seen_idx - {start})[start])
         
         # for component, replace with new r-group
         edit_mol = Chem.RWMol(other_prod_mol)
@@ -365,14 +484,14 @@ def expand_r_group_label_helper(res, coref_smiles_to_graphs, other_prod, molscri
         # for component, get smiles
         sub_mol = Chem.PathToSubmol(other_prod_mol, q)
         smiles = Chem.MolToSmiles(sub_mol)
-        if smiles in coref_smiles_to_graphs.keys():
-            res_to_add = copy.deepcopy(res)
-            # update res_to_add
-            # for each reactant in res_to_add, check if it is the one to be replaced
-            for i, reactant in enumerate(res_to_add['reactants']):
+        if smiles in coref_smiles_to_graphs:
+            # for each reactant in res, check if it is the one to be replaced
+            # only that reactant changes, so the rest of res is shared with the new reaction
+            for i, reactant in enumerate(res['reactants']):
                 if reactant['smiles'] == coref_smiles_to_graphs[smiles]:
-                    res_to_add['reactants'][i]['smiles'] = Chem.MolToSmiles(edit_mol)
-                    res_to_add['reactants'][i]['smiles_no_map'] = Chem.MolToSmiles(edit_mol)
+                    new_smiles = Chem.MolToSmiles(edit_mol)
+                    res_to_add = {k: (list(v) if isinstance(v, list) else v) for k, v in res.items()}
+                    res_to_add['reactants'][i] = {**reactant, 'smiles': new_smiles, 'smiles_no_map': new_smiles}
                     return res_to_add
     return None
 
@@ -385,7 +504,7 @@ def get_r_group_frags_and_substitute(other_prod_mol, query, reactant_mols, react
     parsed: dictionary containing information of how r-groups in query are supposed to be substituted
     toreturn: list of reactions to be returned
     """
-    query_mol = Chem.MolFromSmiles(query)
+    query_mol = _mol_from_smiles(query)
     
     # get r-group sites in query
     query_r_sites = get_sites(query_mol, '[*]', True)
@@ -406,46 +525,38 @@ def get_r_group_frags_and_substitute(other_prod_mol, query, reactant_mols, react
     for other_prod_to_query, query_to_other_prod in zip(other_prod_to_query_list, query_to_other_prod_list):
         # get r-group fragments
         r_group_frags = {}
+        fragment_atoms = get_fragment_atoms(other_prod_mol, other_prod_to_query.keys())
         for atom in other_prod_mol.GetAtoms():
-            if atom.GetIdx() in other_prod_to_query.keys():
+            if atom.GetIdx() in other_prod_to_query:
                 continue
             # if atom is not in query, it is part of an r-group
             # get neighbors of atom
             for neighbor in atom.GetNeighbors():
                 # if neighbor is in query, then this is the attachment point
-                if neighbor.GetIdx() in other_prod_to_query.keys():
+                if neighbor.GetIdx() in other_prod_to_query:
                     # get r-group label in query
                     query_idx = other_prod_to_query[neighbor.GetIdx()]
                     r_label = query_r_labels[query_idx]
                     
                     # get fragment
-                    q = [atom.GetIdx()]
-                    seen = set(q)
-                    head = 0
-                    while head < len(q):
-                        cur = q[head]
-                        head += 1
-                        for n in other_prod_mol.GetAtomWithIdx(cur).GetNeighbors():
-                            if n.GetIdx() not in seen and n.GetIdx() not in other_prod_to_query.keys():
-                                q.append(n.GetIdx())
-                                seen.add(n.GetIdx())
+                    q = list(fragment_atoms[atom.GetIdx()])
                     frag = Chem.PathToSubmol(other_prod_mol, q)
                     frag = Chem.MolToSmiles(frag)
                     r_group_frags[r_label] = frag
         
         # substitute r-groups into reactants
+        # the label patterns and fragments are parsed once here and reused for every reactant
+        replacements = [(_mol_from_smiles(f'[*:{r_label}]'), _mol_from_smiles(frag)) for r_label, frag in r_group_frags.items()]
         new_reactants = []
         for i in range(len(reactant_mols)):
             reactant_mol = reactant_mols[i]
             reactant_info = reactant_information[i]
-            if reactant_info['smiles'] in parsed.keys():
+            if reactant_info['smiles'] in parsed:
                 to_sub = parsed[reactant_info['smiles']]
-                new_mol = Chem.MolFromSmiles(to_sub)
+                new_mol = _mol_from_smiles(to_sub)
                 
-                for r_label, frag in r_group_frags.items():
-                    patt = Chem.MolFromSmiles(f'[*:{r_label}]')
+                for patt, frag_mol in replacements:
                     if new_mol.HasSubstructMatch(patt):
-                        frag_mol = Chem.MolFromSmiles(frag)
                         new_mol = Chem.ReplaceSubstructs(new_mol, patt, frag_mol)[0]
                 new_reactants.append(Chem.MolToSmiles(new_mol))
             else:
@@ -483,9 +594,10 @@ def query_enumeration(prod_template_mol_query, r_sites_reversed_new, num_r_group
     return results
 
 def generate_subsets(n):
+    # tuples, since query_enumeration uses each subset as a dict key
     subsets = []
     def backtrack(start, subset):
-        subsets.append(list(subset))
+        subsets.append(tuple(subset))
         for i in range(start, n):
             subset.append(i)
             backtrack(i + 1, subset)
@@ -493,57 +605,75 @@ def generate_subsets(n):
     backtrack(0, [])
     return subsets
 
-def backout(results, coref_results, molscribe):
+def backout_figure(with_r, coref_res, no_rgroup_mols):
+    """
+    backs out the r-groups of one figure's reactions with r-groups, given as (reaction, product smiles) pairs, against the products without r-groups, returns the new reactions
+    """
+    new_rxns = []
+    if coref_res is None:
+        return new_rxns
+    mol_bboxes_text, coref_smiles, bboxes = coref_res
+    coref_smiles_to_graphs = {}
+    for k, v in coref_smiles.items():
+        for text, smiles in mol_bboxes_text:
+            if v == text:
+                coref_smiles_to_graphs[smiles] = k
+    for rxn, prod_smiles in with_r:
+        # find a similar reaction without r-groups
+        prod_info = _product_info(prod_smiles, star_as_c=True)
+        if prod_info is None:
+            continue
+        prod_mol, prod_fp, _, _ = prod_info
+        for other_prod_mol, other_prod_fp, _, _ in no_rgroup_mols:
+            # a substructure sets a subset of the pattern fingerprint bits, so this screen never drops a match
+            if not DataStructs.AllProbeBitsMatch(other_prod_fp, prod_fp):
+                continue
+            # check if they are similar
+            if prod_mol.HasSubstructMatch(other_prod_mol, _SSS_PARAMS):
+                # they are similar, so we can back out the r-groups
+                # for each reactant, if it is in coref_smiles_to_graphs, then replace it with the corresponding smiles
+                new_rxn = {'reactants': [], 'products': rxn['products']}
+                for reactant in rxn['reactants']:
+                    if 'smiles' in reactant and reactant['smiles'] in coref_smiles_to_graphs:
+                        new_rxn['reactants'].append({'smiles': coref_smiles_to_graphs[reactant['smiles']]})
+                    else:
+                        new_rxn['reactants'].append(reactant)
+                new_rxns.append(new_rxn)
+    return new_rxns
+
+def backout(results, coref_results, molscribe, max_workers=None):
     """
     for each reaction, if it contains an R-group, try to find a similar reaction that does not contain an R-group and "back out" the R-groups
     """
     final_results = []
-    # get all reactions without r-groups
-    for i, res in enumerate(results):
+    with_r = []
+    no_rgroup_mols = []
+    # tag every product once: reactions with r-groups are backed out below,
+    # the others are kept and parsed, together with their pattern fingerprints, as templates
+    for res in results:
         new_res = {'reactions': []}
         final_results.append(new_res)
+        figure_with_r = []
+        with_r.append(figure_with_r)
         for rxn in res['reactions']:
-            if 'smiles' in rxn['products'][0].keys():
-                prod_smiles = rxn['products'][0]['smiles']
-                if prod_smiles is not None and "*" not in prod_smiles and "R" not in prod_smiles:
-                    new_res['reactions'].append(rxn)
-
-    # get all reactions with r-groups
-    for i, res in enumerate(results):
-        coref_res = clean_corefs(coref_results, i)
-        if coref_res is None:
-            continue
-        mol_bboxes_text, coref_smiles, bboxes = coref_res
-        coref_smiles_to_graphs = {}
-        for k, v in coref_smiles.items():
-            for text, smiles in mol_bboxes_text:
-                if v == text:
-                    coref_smiles_to_graphs[smiles] = k
-        for rxn in res['reactions']:
-            if 'smiles' in rxn['products'][0].keys():
-                prod_smiles = rxn['products'][0]['smiles']
-                if prod_smiles is not None and "*" in prod_smiles:
-                    # this is a reaction with r-groups
-                    # find a similar reaction without r-groups
-                    for other_res in results:
-                        for other_rxn in other_res['reactions']:
-                            if 'smiles' in other_rxn['products'][0].keys():
-                                other_prod_smiles = other_rxn['products'][0]['smiles']
-                                if other_prod_smiles is not None and "*" not in other_prod_smiles:
-                                    # this is a reaction without r-groups
-                                    # check if they are similar
-                                    prod_mol = Chem.MolFromSmiles(prod_smiles.replace('*', 'C'))
-                                    other_prod_mol = Chem.MolFromSmiles(other_prod_smiles)
-                                    if prod_mol is not None and other_prod_mol is not None and prod_mol.HasSubstructMatch(other_prod_mol):
-                                        # they are similar, so we can back out the r-groups
-                                        # for each reactant, if it is in coref_smiles_to_graphs, then replace it with the corresponding smiles
-                                        new_rxn = {'reactants': [], 'products': rxn['products']}
-                                        for reactant in rxn['reactants']:
-                                            if 'smiles' in reactant.keys() and reactant['smiles'] in coref_smiles_to_graphs.keys():
-                                                new_rxn['reactants'].append({'smiles': coref_smiles_to_graphs[reactant['smiles']]})
-                                            else:
-                                                new_rxn['reactants'].append(reactant)
-                                        new_res['reactions'].append(new_rxn)
+            prod_smiles = rxn['products'][0].get('smiles')
+            if prod_smiles is None:
+                continue
+            if "*" in prod_smiles:
+                figure_with_r.append((rxn, prod_smiles))
+                continue
+            if "R" not in prod_smiles:
+                new_res['reactions'].append(rxn)
+            prod_info = _product_info(prod_smiles)
+            if prod_info is not None:
+                no_rgroup_mols.append(prod_info)
+
+    # get all reactions with r-groups, one figure per worker
+    corefs = [clean_corefs(coref_results, i) for i in range(len(results))]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        figure_rxns = executor.map(lambda i: backout_figure(with_r[i], corefs[i], no_rgroup_mols), range(len(results)))
+        for new_rxns in figure_rxns:
+            new_res['reactions'].extend(new_rxns)
     return final_results
 
     # for each product, get atom mapping
@@ -627,13 +757,13 @@ def associate_corefs(results, results_coref):
             continue
         mol_bboxes_text, coref_smiles, bboxes = coref_res
         for rxn in res['reactions']:
-            if 'smiles' not in rxn['products'][0].keys() or rxn['products'][0]['smiles'] is None:
+            if 'smiles' not in rxn['products'][0] or rxn['products'][0]['smiles'] is None:
                 continue
             prod_smiles = rxn['products'][0]['smiles']
             if "*" in prod_smiles:
                 # this is a reaction with r-groups
                 # get r-group labels
-                prod_mol = Chem.MolFromSmiles(prod_smiles)
+                prod_mol = _mol_from_smiles(prod_smiles)
                 r_labels = []
                 for atom in prod_mol.GetAtoms():
                     if atom.GetAtomicNum() == 0:
@@ -642,53 +772,102 @@ def associate_corefs(results, results_coref):
                 # for each r-group, find its smiles from coref
                 r_group_smiles = {}
                 for r_label in r_labels:
-                    if r_label in coref_smiles.keys():
+                    if r_label in coref_smiles:
                         r_group_smiles[r_label] = coref_smiles[r_label]
                 
                 # expand reaction
                 new_rxn = {'reactants': rxn['reactants'], 'products': rxn['products']}
                 for r_label, smiles in r_group_smiles.items():
                     for reactant in new_rxn['reactants']:
-                        if 'smiles' in reactant.keys() and reactant['smiles'] == f'[{r_label}]':
+                        if 'smiles' in reactant and reactant['smiles'] == f'[{r_label}]':
                             reactant['smiles'] = smiles
                 res['reactions'].append(new_rxn)
 
     return results
 
-def expand_reactions_with_backout(initial_results, results_coref, molscribe): 
+def expand_figure_with_backout(res, coref_res, molscribe, first_match_only=True):
+    """
+    expands the r-group reactions of one figure against its reactions without r-groups, returns the new reactions
+    """
+    new_reactions = []
+    if coref_res is None:
+        return new_reactions
+    mol_bboxes_text, coref_smiles, bboxes = coref_res
+    seen = set()
+
+    # split the reactions by whether their product has r-groups
+    with_r = []
+    without_r = []
+    for rxn in res['reactions']:
+        prod_smiles = rxn['products'][0].get('smiles')
+        if prod_smiles is None:
+            continue
+        if "*" in prod_smiles:
+            with_r.append((rxn, prod_smiles))
+        else:
+            prod_info = _product_info(prod_smiles)
+            if prod_info is not None:
+                without_r.append((rxn, prod_smiles) + prod_info)
+
+    if not without_r:
+        return new_reactions
+    candidate_heavy = np.array([candidate[4] for candidate in without_r])
+    candidate_bits = np.stack([candidate[5] for candidate in without_r])
+
+    # for each reaction with r-groups
+    for rxn, prod_smiles_with_r in with_r:
+        prod_mol_with_r = _mol_from_smiles(prod_smiles_with_r)
+        if prod_mol_with_r is None:
+            continue
+        # the template query depends only on this reaction
+        query_info = _query_info(prod_smiles_with_r)
+        if query_info is None:
+            continue
+        query, query_fp, query_heavy, query_bits = query_info
+        # screen all candidates at once: a substructure cannot have more heavy atoms than the molecule containing it,
+        # and every bit of its pattern fingerprint must be set in the candidate's
+        possible = (candidate_heavy >= query_heavy) & ~np.any(query_bits & ~candidate_bits, axis=1)
+        # find a similar reaction without r-groups
+        for j in np.flatnonzero(possible):
+            other_rxn, prod_smiles_no_r, prod_mol_no_r = without_r[j][:3]
+            if prod_mol_no_r.HasSubstructMatch(query, _SSS_PARAMS):
+                # similar reaction found
+                # expand r-groups
+                new_rxn = expand_r_group_label_helper(other_rxn, coref_smiles, (None, prod_smiles_no_r), molscribe)
+                if new_rxn is not None:
+                    # several r-group reactions can share a template and produce the same expansion
+                    key = _reaction_key(new_rxn)
+                    if key not in seen:
+                        seen.add(key)
+                        new_reactions.append(new_rxn)
+                    if first_match_only:
+                        break
+    return new_reactions
+
+def expand_reactions_with_backout(initial_results, results_coref, molscribe, first_match_only=True, max_workers=None): 
     # for each reaction with R-groups, find a corresponding reaction without R-groups in the same figure
     # if found, use that as a template to expand the R-group reaction
-    results = copy.deepcopy(initial_results)
-    for i, res in enumerate(results):
-        res['reactions_to_add'] = []
-        coref_res = clean_corefs(results_coref, i)
-        if coref_res is None:
-            continue
-        mol_bboxes_text, coref_smiles, bboxes = coref_res
-        
-        # for each reaction with r-groups
-        for rxn in res['reactions']:
-            if 'smiles' in rxn['products'][0].keys() and rxn['products'][0]['smiles'] is not None and "*" in rxn['products'][0]['smiles']:
-                prod_smiles_with_r = rxn['products'][0]['smiles']
-                prod_mol_with_r = Chem.MolFromSmiles(prod_smiles_with_r)
-                if prod_mol_with_r is None:
-                    continue
-                # find a similar reaction without r-groups
-                for other_rxn in res['reactions']:
-                    if 'smiles' in other_rxn['products'][0].keys() and other_rxn['products'][0]['smiles'] is not None and "*" not in other_rxn['products'][0]['smiles']:
-                        prod_smiles_no_r = other_rxn['products'][0]['smiles']
-                        prod_mol_no_r = Chem.MolFromSmiles(prod_smiles_no_r)
-                        if prod_mol_no_r is None:
-                            continue
-                        
-                        prod_mol_with_r_no_r = Chem.MolFromSmiles(prod_smiles_with_r.replace('*', 'C'))
-                        if prod_mol_no_r.HasSubstructMatch(prod_mol_with_r_no_r):
-                            # similar reaction found
-                            # expand r-groups
-                            new_rxn = expand_r_group_label_helper(other_rxn, coref_smiles, (None, prod_smiles_no_r), molscribe)
-                            if new_rxn is not None:
-                                res['reactions_to_add'].append(new_rxn)
-    for res in results:
-        res['reactions'].extend(res['reactions_to_add'])
-        del res['reactions_to_add']
-    return results
\ No newline at end of file
+    # with first_match_only, the search stops at the first template that expands successfully
+    # figures are independent, so they are expanded on a thread pool
+    corefs = [clean_corefs(results_coref, i) for i in range(len(initial_results))]
+    def expand(i):
+        return expand_figure_with_backout(initial_results[i], corefs[i], molscribe, first_match_only)
+
+    if len(initial_results) > 1:
+        # parse every distinct product up front so the figure workers only hit the cache
+        unique_smiles = set()
+        for res in initial_results:
+            for rxn in res['reactions']:
+                prod_smiles = rxn['products'][0].get('smiles')
+                if prod_smiles is not None:
+                    unique_smiles.add(prod_smiles)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            with_r = [smiles for smiles in unique_smiles if "*" in smiles]
+            list(executor.map(_product_info, [smiles for smiles in unique_smiles if "*" not in smiles]))
+            list(executor.map(_mol_from_smiles, with_r))
+            list(executor.map(_query_info, with_r))
+            added = list(executor.map(expand, range(len(initial_results))))
+    else:
+        added = [expand(i) for i in range(len(initial_results))]
+    # only the reaction lists grow, so the reaction dicts themselves are shared with initial_results
+    return [{**res, 'reactions': res['reactions'] + new_reactions} for res, new_reactions in zip(initial_results, added)]